@@ -0,0 +1,534 @@
+# -*- coding: utf-8 -*-
+'''
+Bencode helpers for working on large bit torrent files in place.
+
+Data are decoded straight from a buffer, typically a memory-mapped file,
+without reading the whole file in memory first. Byte strings are returned
+as memoryview slices of the buffer rather than copies.
+
+Original on: https://github.com/m000/cliutils
+'''
+
+import contextlib
+import hashlib
+import mmap
+import os
+import tempfile
+from collections.abc import Mapping, MutableMapping
+
+_DIGITS = frozenset(b'0123456789')
+_D, _L, _I, _E = b'dlie'
+
+
+class DecodeError(ValueError):
+    ''' Raised when the input is not valid bencoded data.'''
+    def __init__(self, msg, pos):
+        super().__init__('%s at offset %d' % (msg, pos))
+        self.pos = pos
+
+
+###############################################################################
+#### Buffers ##################################################################
+###############################################################################
+def _map(filename):
+    ''' Memory-maps filename read-only.
+        Empty files can't be mapped, so an empty bytes object is used instead.
+    '''
+    with open(filename, 'rb') as f:
+        try:
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            return b''
+
+@contextlib.contextmanager
+def mapped(filename):
+    ''' Memory-maps filename read-only for the duration of the context.'''
+    buf = _map(filename)
+    try:
+        yield buf
+    finally:
+        try:
+            buf.close()
+        except AttributeError:
+            pass
+        except BufferError:
+            # Memoryviews of the map are still alive. The mapping will
+            # be released when they are garbage collected.
+            pass
+
+def load(filename):
+    ''' Returns a LazyDict over the memory-mapped contents of filename.
+        The mapping stays open for as long as the LazyDict is alive.
+    '''
+    return LazyDict(_map(filename))
+
+
+###############################################################################
+#### Decoding #################################################################
+###############################################################################
+def to_str(raw):
+    ''' Converts a raw byte string to str.
+        Non-utf8 data survive the conversion via surrogate escapes, so
+        encode() turns the result back to the exact original bytes.
+    '''
+    return bytes(raw).decode('utf-8', 'surrogateescape')
+
+def to_bytes(s):
+    ''' Converts a str from to_str() back to the original byte string.'''
+    return s.encode('utf-8', 'surrogateescape')
+
+def _read_int(buf, pos):
+    ''' Reads the integer starting at pos (just after the 'i').
+        Returns the value and the offset past the terminating 'e'.
+    '''
+    end = buf.find(b'e', pos)
+    if end < 0:
+        raise DecodeError('unterminated integer', pos)
+    try:
+        return int(buf[pos:end]), end + 1
+    except ValueError:
+        raise DecodeError('invalid integer', pos) from None
+
+def _read_str(buf, pos):
+    ''' Reads the length prefix of the string starting at pos.
+        Returns the start and end offsets of the string contents.
+    '''
+    colon = buf.find(b':', pos)
+    if colon < 0:
+        raise DecodeError('unterminated string length', pos)
+    try:
+        start, end = colon + 1, colon + 1 + int(buf[pos:colon])
+    except ValueError:
+        raise DecodeError('invalid string length', pos) from None
+    if end > len(buf):
+        raise DecodeError('truncated string', pos)
+    return start, end
+
+def iterdecode(buf, pos=0):
+    ''' Incrementally decodes the value starting at offset pos of buf.
+        Yields (path, value) events in the order they are encountered,
+        where path is a tuple of dictionary keys and list indices.
+        Opening a dictionary or list yields dict or list as the value.
+        Byte strings are yielded as memoryview slices of buf.
+        buf must support find() and slicing, e.g. bytes or mmap.
+    '''
+    mv = memoryview(buf)
+    path = []
+    stack = []   # None for open dicts, [next index] for open lists
+    try:
+        while True:
+            if stack:
+                top = stack[-1]
+                if buf[pos] == _E:
+                    pos += 1
+                    stack.pop()
+                    if not stack:
+                        return pos
+                    path.pop()
+                    continue
+                if top is None:
+                    start, pos = _read_str(buf, pos)
+                    path.append(to_str(mv[start:pos]))
+                else:
+                    path.append(top[0])
+                    top[0] += 1
+
+            c = buf[pos]
+            if c == _D:
+                yield tuple(path), dict
+                stack.append(None)
+                pos += 1
+                continue
+            elif c == _L:
+                yield tuple(path), list
+                stack.append([0])
+                pos += 1
+                continue
+            elif c == _I:
+                value, pos = _read_int(buf, pos + 1)
+            elif c in _DIGITS:
+                start, pos = _read_str(buf, pos)
+                value = mv[start:pos]
+            else:
+                raise DecodeError('unexpected %r' % (chr(c)), pos)
+
+            yield tuple(path), value
+            if not stack:
+                return pos
+            path.pop()
+    except IndexError:
+        raise DecodeError('unexpected end of data', pos) from None
+
+def decode(buf, pos=0):
+    ''' Decodes the value starting at offset pos of buf.
+        Returns the value and the offset past its end.
+        Byte strings are converted to str using to_str().
+    '''
+    try:
+        c = buf[pos]
+        if c == _I:
+            return _read_int(buf, pos + 1)
+        elif c in _DIGITS:
+            start, end = _read_str(buf, pos)
+            return to_str(buf[start:end]), end
+        elif c == _L:
+            value = []
+            pos += 1
+            while buf[pos] != _E:
+                item, pos = decode(buf, pos)
+                value.append(item)
+            return value, pos + 1
+        elif c == _D:
+            value = {}
+            pos += 1
+            while buf[pos] != _E:
+                start, pos = _read_str(buf, pos)
+                value[to_str(buf[start:pos])], pos = decode(buf, pos)
+            return value, pos + 1
+        raise DecodeError('unexpected %r' % (chr(c)), pos)
+    except IndexError:
+        raise DecodeError('unexpected end of data', pos) from None
+
+def skip(buf, pos=0):
+    ''' Returns the offset past the end of the value starting at offset pos
+        of buf, without decoding anything.
+    '''
+    depth = 0
+    try:
+        while True:
+            c = buf[pos]
+            if c == _D or c == _L:
+                depth += 1
+                pos += 1
+                continue
+            elif c == _E and depth > 0:
+                depth -= 1
+                pos += 1
+            elif c == _I:
+                pos = _read_int(buf, pos + 1)[1]
+            elif c in _DIGITS:
+                pos = _read_str(buf, pos)[1]
+            else:
+                raise DecodeError('unexpected %r' % (chr(c)), pos)
+            if depth == 0:
+                return pos
+    except IndexError:
+        raise DecodeError('unexpected end of data', pos) from None
+
+def index(buf, pos=0):
+    ''' Indexes the dictionary starting at offset pos of buf in one pass,
+        without decoding its values.
+        Returns a dict mapping each key to the (key, value, end) offsets of
+        its entry, and the offset past the end of the dictionary.
+    '''
+    try:
+        if buf[pos] != _D:
+            raise DecodeError('not a dictionary', pos)
+        offsets = {}
+        pos += 1
+        while buf[pos] != _E:
+            kpos = pos
+            start, vpos = _read_str(buf, pos)
+            pos = skip(buf, vpos)
+            offsets[to_str(buf[start:vpos])] = (kpos, vpos, pos)
+        return offsets, pos + 1
+    except IndexError:
+        raise DecodeError('unexpected end of data', pos) from None
+
+def info_hash(buf):
+    ''' Returns the info-hash of the torrent metainfo in buf, i.e. the
+        SHA-1 hex digest of its info dictionary. The hash is taken over
+        the raw bytes of the dictionary, without decoding it.
+    '''
+    kpos, vpos, end = index(buf)[0]['info']
+    return hashlib.sha1(memoryview(buf)[vpos:end]).hexdigest()
+
+
+###############################################################################
+#### Queries ##################################################################
+###############################################################################
+def parse_query(expr):
+    ''' Parses a path expression into a list of (type, key) steps, where
+        type is dict or list and a key of None matches anything.
+        Dictionary keys are separated by dots and may be quoted with ' or "
+        when they contain dots or brackets. * matches any key. List items
+        are selected with [n], or [*] for all items. E.g.:
+            *.label
+            "movie.torrent".path
+            info.files[*].length
+        Raises ValueError for malformed expressions.
+    '''
+    steps = []
+    pos = 0
+    while pos < len(expr):
+        if expr[pos] == '[':
+            end = expr.find(']', pos)
+            if end < 0:
+                raise ValueError('unterminated [ at %d' % (pos))
+            item = expr[pos+1:end]
+            if item != '*' and not item.isdigit():
+                raise ValueError('invalid list index %r at %d' % (item, pos))
+            steps.append((list, None if item == '*' else int(item)))
+            pos = end + 1
+            continue
+        if steps:
+            if expr[pos] != '.':
+                raise ValueError('expected . at %d' % (pos))
+            pos += 1
+        if pos < len(expr) and expr[pos] in '"\'':
+            end = expr.find(expr[pos], pos + 1)
+            if end < 0:
+                raise ValueError('unterminated quote at %d' % (pos))
+            steps.append((dict, expr[pos+1:end]))
+            pos = end + 1
+            continue
+        end = pos
+        while end < len(expr) and expr[end] not in '.[]':
+            end += 1
+        if end == pos:
+            raise ValueError('empty key at %d' % (pos))
+        key = expr[pos:end]
+        steps.append((dict, None if key == '*' else key))
+        pos = end
+    return steps
+
+def _query(buf, steps, pos, path):
+    if not steps:
+        value, end = decode(buf, pos)
+        yield path, value
+        return end
+    (kind, want), rest = steps[0], steps[1:]
+    c = buf[pos]
+    if c == _D and kind is dict:
+        pos += 1
+        while buf[pos] != _E:
+            start, pos = _read_str(buf, pos)
+            key = to_str(buf[start:pos])
+            if want is None or want == key:
+                pos = yield from _query(buf, rest, pos, path + (key,))
+            else:
+                pos = skip(buf, pos)
+        return pos + 1
+    elif c == _L and kind is list:
+        pos += 1
+        i = 0
+        while buf[pos] != _E:
+            if want is None or want == i:
+                pos = yield from _query(buf, rest, pos, path + (i,))
+            else:
+                pos = skip(buf, pos)
+            i += 1
+        return pos + 1
+    return skip(buf, pos)
+
+def query(buf, steps, pos=0):
+    ''' Evaluates the steps from parse_query() on the value starting at
+        offset pos of buf, in a single pass. Yields (path, value) for the
+        matching values, decoded as in decode(). Subtrees that can't match
+        are skipped without being decoded.
+    '''
+    try:
+        yield from _query(buf, steps, pos, ())
+    except IndexError:
+        raise DecodeError('unexpected end of data', len(buf)) from None
+
+
+class LazyDict(MutableMapping):
+    ''' Dictionary over a bencoded dictionary in buf.
+        Keys are indexed on first use. Values are decoded only when they
+        are accessed, with nested dictionaries returned as LazyDicts.
+        Assignments and deletions are recorded on top of the buffer,
+        which is never modified.
+    '''
+    def __init__(self, buf, pos=0):
+        self.buf = buf
+        self.pos = pos
+        self._offsets = None
+        self._end = None
+        self._values = {}
+        self._assigned = set()
+        self._deleted = set()
+
+    @property
+    def offsets(self):
+        ''' Maps the keys in the buffer to their (key, value, end) offsets.'''
+        if self._offsets is None:
+            self._offsets, self._end = index(self.buf, self.pos)
+        return self._offsets
+
+    @property
+    def end(self):
+        ''' Offset past the end of the dictionary in the buffer.'''
+        self.offsets
+        return self._end
+
+    def raw(self):
+        ''' Returns the original encoded dictionary as a memoryview.'''
+        return memoryview(self.buf)[self.pos:self.end]
+
+    @property
+    def dirty(self):
+        ''' Whether the dictionary differs from its encoded original.'''
+        return bool(self._assigned or self._deleted or any(
+            isinstance(v, LazyDict) and v.dirty for v in self._values.values()
+        ))
+
+    def __getitem__(self, key):
+        if key in self._values:
+            return self._values[key]
+        if key in self._deleted or key not in self.offsets:
+            raise KeyError(key)
+        vpos = self.offsets[key][1]
+        if self.buf[vpos] == _D:
+            value = LazyDict(self.buf, vpos)
+        else:
+            value = decode(self.buf, vpos)[0]
+        self._values[key] = value
+        return value
+
+    def __setitem__(self, key, value):
+        self._values[key] = value
+        self._assigned.add(key)
+        self._deleted.discard(key)
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        self._values.pop(key, None)
+        self._assigned.discard(key)
+        if key in self.offsets:
+            self._deleted.add(key)
+
+    def __contains__(self, key):
+        return key in self._assigned or (
+                key in self.offsets and key not in self._deleted)
+
+    def __iter__(self):
+        for key in self.offsets:
+            if key not in self._deleted:
+                yield key
+        for key in self._assigned:
+            if key not in self.offsets:
+                yield key
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def edits(self):
+        ''' Returns the edits made on top of the buffer as a dict of the
+            replaced or added values and a set of the deleted keys.
+        '''
+        replace = {k: v for k, v in self._values.items() if k in self._assigned
+            or (isinstance(v, LazyDict) and v.dirty)}
+        return replace, set(self._deleted)
+
+
+###############################################################################
+#### Encoding #################################################################
+###############################################################################
+def _encode(value, chunks):
+    if isinstance(value, LazyDict) and not value.dirty:
+        chunks.append(bytes(value.raw()))
+    elif isinstance(value, int):
+        chunks.append(b'i%de' % (value))
+    elif isinstance(value, (str, bytes, bytearray, memoryview)):
+        if isinstance(value, str):
+            value = to_bytes(value)
+        chunks.append(b'%d:' % (len(value)))
+        chunks.append(bytes(value))
+    elif isinstance(value, (list, tuple)):
+        chunks.append(b'l')
+        for item in value:
+            _encode(item, chunks)
+        chunks.append(b'e')
+    elif isinstance(value, Mapping):
+        items = sorted(
+            (_key_bytes(k), v) for k, v in value.items()
+        )
+        chunks.append(b'd')
+        for k, v in items:
+            _encode(k, chunks)
+            _encode(v, chunks)
+        chunks.append(b'e')
+    else:
+        raise TypeError('cannot bencode %s' % (type(value).__name__))
+
+def encode(value):
+    ''' Bencodes value. Unmodified LazyDicts are copied verbatim from
+        their buffer instead of being re-encoded.
+    '''
+    chunks = []
+    _encode(value, chunks)
+    return b''.join(chunks)
+
+def _key_bytes(key):
+    return to_bytes(key) if isinstance(key, str) else bytes(key)
+
+def write_patched(filename, buf, replace=None, delete=(), bufsize=1<<20):
+    ''' Writes the top-level dictionary encoded in buf to filename, with
+        the values of the keys in replace replaced (or added) and the keys
+        in delete removed. Untouched entries are copied verbatim from buf,
+        so only the edited entries are re-encoded.
+        The output is written to a temporary file that atomically replaces
+        filename when complete, so filename may also be the source of buf.
+    '''
+    replace = replace if replace is not None else {}
+    offsets, end = index(buf)
+    mv = memoryview(buf)
+
+    # Merge the sorted original keys with any added keys.
+    added = sorted((_key_bytes(k), k) for k in replace if k not in offsets)
+    entries = []
+    i = 0
+    for key, (kpos, vpos, epos) in offsets.items():
+        kraw = _key_bytes(key)
+        while i < len(added) and added[i][0] < kraw:
+            entries.append((added[i][1], None))
+            i += 1
+        entries.append((key, (kpos, epos)))
+    entries.extend((k, None) for _, k in added[i:])
+
+    dirname, basename = os.path.split(os.path.abspath(filename))
+    fd, tmp_filename = tempfile.mkstemp(prefix='.%s.' % (basename), dir=dirname)
+    try:
+        with open(fd, 'wb', buffering=bufsize) as out:
+            out.write(b'd')
+            run = None  # pending range of untouched entries
+            for key, span in entries:
+                if key not in delete and key not in replace:
+                    if run is not None and run[1] == span[0]:
+                        run[1] = span[1]
+                        continue
+                    if run is not None:
+                        out.write(mv[run[0]:run[1]])
+                    run = list(span)
+                    continue
+                if run is not None:
+                    out.write(mv[run[0]:run[1]])
+                    run = None
+                if key in delete:
+                    continue
+                out.write(encode(key))
+                out.write(encode(replace[key]))
+            if run is not None:
+                out.write(mv[run[0]:run[1]])
+            out.write(b'e')
+            out.flush()
+            os.fsync(out.fileno())
+        try:
+            os.chmod(tmp_filename, os.stat(filename).st_mode & 0o7777)
+        except FileNotFoundError:
+            os.chmod(tmp_filename, 0o644)
+        os.replace(tmp_filename, filename)
+    except BaseException:
+        try:
+            os.unlink(tmp_filename)
+        except OSError:
+            pass
+        raise
+    finally:
+        mv.release()
+
+def save(d, filename):
+    ''' Writes the LazyDict d to filename, re-encoding only its edits.'''
+    write_patched(filename, d.buf, *d.edits())
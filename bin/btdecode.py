@@ -1,33 +1,233 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 #
 # Decodes bencoded bit torrent files and dumps them to stdout.
+# Decoding is incremental over a memory-mapped file, so output starts
+# right away and memory use does not depend on the file size.
+#
+# With -q, only the values matching a path expression are printed,
+# as JSON Lines or TSV. Non-matching subtrees are skipped undecoded.
+#
+# Multiple files, directories (for the .torrent files in them) or globs
+# are processed in batch over a process pool. Batch output is a summary
+# line for each file, or its query matches with -q, in input order.
 #
 # Original on: https://github.com/m000/cliutils
 #
 
-from __future__ import print_function
-import sys
-from pprint import pprint
+import os, sys, glob, json, argparse
+import hashlib
+import functools
+import concurrent.futures
 
-HR_LENGTH = 70
+from btcodec import DecodeError, decode, index, iterdecode, mapped, parse_query, query, to_bytes
 
-try:
-    import bencode
-except ImportError:
-    print("Please install the bencode python module. E.g.: sudo pip install bencode", file=sys.stderr)
+INDENT = '  '
+POOL_MIN_FILES = 32  # below this, decoding inline beats starting worker processes
+POOL_CHUNK_FILES = 8  # small chunks, torrent files vary a lot in size
+FILE_LENGTHS = parse_query('[*].length')
 
-if __name__ == '__main__':
+def format_value(value):
+    ''' Formats a decoded leaf value for printing.
+        Strings that are valid utf-8 are printed as text, the rest as bytes.
+    '''
+    if isinstance(value, int):
+        return str(value)
+    value = bytes(value)
+    try:
+        return repr(value.decode('utf-8'))
+    except UnicodeDecodeError:
+        return repr(value)
 
-    if len(sys.argv) < 1:
-        print("Bit Torrent file decode wrapper.", file=sys.stderr)
-        print("Usage: %s <datfile>" % (sys.argv[0]), file=sys.stderr)
-        sys.exit(1)
+def dump(buf, file=sys.stdout):
+    ''' Streams an indented outline of the bencoded data in buf to file.'''
+    for path, value in iterdecode(buf):
+        if not path:
+            label = ''
+        elif isinstance(path[-1], int):
+            label = '[%d]: ' % (path[-1])
+        else:
+            label = '%s: ' % (path[-1])
+        indent = INDENT * max(len(path) - 1, 0)
+        if value is dict or value is list:
+            if path:
+                print('%s%s' % (indent, label.rstrip()), file=file)
+        else:
+            print('%s%s%s' % (indent, label, format_value(value)), file=file)
+
+def jsonable(value):
+    ''' Converts a decoded value for JSON output.
+        Strings that are not valid utf-8 (e.g. hashes) are hex encoded.
+    '''
+    if isinstance(value, str):
+        try:
+            value.encode('utf-8')
+            return value
+        except UnicodeEncodeError:
+            return to_bytes(value).hex()
+    elif isinstance(value, list):
+        return [jsonable(v) for v in value]
+    elif isinstance(value, dict):
+        return {jsonable(k): jsonable(v) for k, v in value.items()}
+    return value
+
+def format_path(path):
+    ''' Formats a query match path, e.g. as info.files[0].length.'''
+    s = ''
+    for p in path:
+        if isinstance(p, int):
+            s += '[%d]' % (p)
+        elif '.' in p or '[' in p or ']' in p:
+            s += '%s"%s"' % ('.' if s else '', p)
+        else:
+            s += '%s%s' % ('.' if s else '', p)
+    return s
+
+def format_tsv(value):
+    ''' Formats a query match value as a TSV field.'''
+    value = jsonable(value)
+    if isinstance(value, str):
+        return value.replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n')
+    return json.dumps(value, ensure_ascii=False)
+
+def query_lines(buf, steps, fmt='jsonl', filename=None):
+    ''' Yields the output lines for the values matching the query steps in
+        buf. If filename is given, it is included in each line.
+    '''
+    for path, value in query(buf, steps):
+        if fmt == 'tsv':
+            fields = [format_path(path), value] if filename is None else [filename, format_path(path), value]
+            yield '\t'.join(map(format_tsv, fields))
+        else:
+            line = {} if filename is None else {'file': filename}
+            line.update(path=jsonable(list(path)), value=jsonable(value))
+            yield json.dumps(line, ensure_ascii=False)
+
+def dump_query(buf, steps, fmt='jsonl', file=sys.stdout):
+    ''' Streams the values matching the query steps in buf to file.'''
+    for line in query_lines(buf, steps, fmt):
+        print(line, file=file)
+
+
+###############################################################################
+#### Batch mode ###############################################################
+###############################################################################
+def expand_inputs(inputs):
+    ''' Expands the input arguments to a list of files. Directories are
+        expanded to the .torrent files in them, and globs to their matches.
+    '''
+    files = []
+    for i in inputs:
+        if os.path.isdir(i):
+            with os.scandir(i) as it:
+                files.extend(sorted(e.path for e in it if e.name.endswith('.torrent') and e.is_file()))
+        elif glob.has_magic(i):
+            files.extend(sorted(glob.glob(i)))
+        else:
+            files.append(i)
+    return files
+
+def summarize(buf):
+    ''' Returns the info-hash, name, total size and number of files of the
+        torrent metainfo in buf. The piece hashes are never decoded.
+    '''
+    kpos, vpos, end = index(buf)[0]['info']
+    info = index(buf, vpos)[0]
+    name = decode(buf, info['name'][1])[0] if 'name' in info else None
+    if 'files' in info:
+        lengths = [v for _, v in query(buf, FILE_LENGTHS, info['files'][1])]
+    else:
+        lengths = [decode(buf, info['length'][1])[0]] if 'length' in info else []
+    return hashlib.sha1(memoryview(buf)[vpos:end]).hexdigest(), name, sum(lengths), len(lengths)
+
+def batch_lines(filename, steps=None, fmt='jsonl'):
+    ''' Returns the output lines for filename in batch mode: its query
+        matches if steps are given, else a summary line.
+        Returns whether filename was processed successfully and the lines.
+        Errors are output as a line with an error field.
+    '''
+    try:
+        with mapped(filename) as buf:
+            if steps is not None:
+                return True, list(query_lines(buf, steps, fmt, filename))
+            thash, name, size, nfiles = summarize(buf)
+    except (OSError, DecodeError, KeyError) as e:
+        error = str(e) if not isinstance(e, KeyError) else 'no %s' % (e)
+        if fmt == 'tsv':
+            return False, ['%s\terror\t%s' % (format_tsv(filename), format_tsv(error))]
+        return False, [json.dumps({'file': filename, 'error': error}, ensure_ascii=False)]
+    if fmt == 'tsv':
+        return True, ['\t'.join(map(format_tsv, [filename, thash, name, size, nfiles]))]
+    return True, [json.dumps({'file': filename, 'info_hash': thash, 'name': jsonable(name),
+        'size': size, 'files': nfiles}, ensure_ascii=False)]
+
+def batch(files, steps=None, fmt='jsonl', jobs=None, file=sys.stdout):
+    ''' Processes files in batch over a process pool, writing the output
+        to file in the order of files. Returns the number of failed files.
+    '''
+    work = functools.partial(batch_lines, steps=steps, fmt=fmt)
+    failed = 0
+    def output(results):
+        nonlocal failed
+        for ok, lines in results:
+            failed += not ok
+            for line in lines:
+                print(line, file=file)
+
+    if len(files) < POOL_MIN_FILES:
+        output(map(work, files))
+    else:
+        with concurrent.futures.ProcessPoolExecutor(jobs) as pool:
+            output(pool.map(work, files, chunksize=POOL_CHUNK_FILES))
+    return failed
+
+
+def query_arg(expr):
+    try:
+        return parse_query(expr)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError('invalid query %r: %s' % (expr, e))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='''Bit Torrent file decode wrapper.
+        Dumps an outline of the bencoded file, or the values matching a query.
+        In batch mode, a summary of each file is output instead, as JSON Lines
+        with its info-hash, name, total size and number of files.
+    ''')
+    parser.add_argument('-q', '--query', type=query_arg, default=None,
+        action='store', dest='query', metavar='EXPR',
+        help='only print values matching EXPR, e.g. "*.label", "\'movie.torrent\'.path", "info.files[*].length"'
+    )
+    parser.add_argument('-f', '--format', choices=('jsonl', 'tsv'), default='jsonl',
+        action='store', dest='format',
+        help='output format for query matches and batch mode (default: jsonl). Non-utf8 strings are hex encoded'
+    )
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+        action='store', dest='jobs',
+        help='number of processes to use in batch mode (default: number of cpus)'
+    )
+    parser.add_argument('inputs', nargs='+', metavar='datfile',
+        help='bencoded file, e.g. resume.dat or a .torrent. '
+            'Multiple files, directories or globs are processed in batch'
+    )
+    args = parser.parse_args()
+    files = expand_inputs(args.inputs)
 
     ################################################
-    # Read resume data.
+    # Batch mode.
     ################################################
-    with open(sys.argv[1]) as dat_in:
-        resume_dat = bencode.bdecode(dat_in.read())
-        pprint(resume_dat)
+    if files != args.inputs or len(files) > 1:
+        sys.exit(1 if batch(files, args.query, args.format, args.jobs) else 0)
 
+    ################################################
+    # Stream resume data.
+    ################################################
+    try:
+        with mapped(files[0]) as buf:
+            if args.query is None:
+                dump(buf)
+            else:
+                dump_query(buf, args.query, args.format)
+    except (OSError, DecodeError) as e:
+        print('%s: %s' % (files[0], e.strerror if isinstance(e, OSError) and e.strerror else e), file=sys.stderr)
+        sys.exit(1)
@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+'''
+Verifies downloaded bit torrent data against the piece hashes of the
+.torrent file. Pieces are mapped onto the file layout of the torrent and
+hashed in parallel over memory-mapped files.
+
+Original on: https://github.com/m000/cliutils
+'''
+
+import os, sys, mmap, hashlib, argparse
+import itertools
+import concurrent.futures
+
+import btcodec
+
+PIECE_BATCH = 64        # pieces per pool task
+MAX_MAPPED_FILES = 256  # mapped files kept open by each worker
+
+
+###############################################################################
+#### Layout ###################################################################
+###############################################################################
+def load_info(torrent_f):
+    ''' Loads the info dictionary of torrent_f, without decoding the rest.'''
+    with btcodec.mapped(torrent_f) as buf:
+        return btcodec.decode(buf, btcodec.index(buf)[0]['info'][1])[0]
+
+def torrent_files(info, path):
+    ''' Returns the (path, length) tuples of the files of the torrent with
+        the specified info dictionary, stored under path.
+        For single file torrents, path is the file itself, as in uTorrent's
+        resume.dat. BEP47 padding files are returned with a path of None.
+    '''
+    if 'files' not in info:
+        return [(path, info['length'])]
+    files = []
+    for f in info['files']:
+        if 'p' in f.get('attr', ''):
+            files.append((None, f['length']))
+        else:
+            files.append((os.path.join(path, *f['path']), f['length']))
+    return files
+
+def piece_segments(files, piece_length):
+    ''' Maps the pieces of the torrent onto its files. Yields the list of
+        (path, offset, length) segments that make up each piece in turn.
+    '''
+    segs = []
+    room = piece_length
+    for path, length in files:
+        offset = 0
+        while offset < length:
+            n = min(room, length - offset)
+            segs.append((path, offset, n))
+            offset += n
+            room -= n
+            if room == 0:
+                yield segs
+                segs = []
+                room = piece_length
+    if segs:
+        yield segs
+
+
+###############################################################################
+#### Hashing ##################################################################
+###############################################################################
+_mapped = {}
+
+def _map(path):
+    ''' Returns a memoryview of path, mapped read-only, or None.'''
+    if path not in _mapped:
+        if len(_mapped) >= MAX_MAPPED_FILES:
+            _mapped.clear()
+        try:
+            with open(path, 'rb') as f:
+                _mapped[path] = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+        except (OSError, ValueError):
+            _mapped[path] = None
+    return _mapped[path]
+
+def check_pieces(first, hashes, segments):
+    ''' Hashes the pieces starting from first, made up of the specified
+        segments, and compares them to the expected hashes.
+        Returns the indices of the pieces that don't match.
+    '''
+    bad = []
+    for i, (expected, segs) in enumerate(zip(hashes, segments)):
+        h = hashlib.sha1()
+        for path, offset, length in segs:
+            if path is None:
+                h.update(bytes(length))
+                continue
+            buf = _map(path)
+            if buf is None or offset + length > len(buf):
+                h = None
+                break
+            h.update(buf[offset:offset+length])
+        if h is None or h.digest() != expected:
+            bad.append(first + i)
+    return bad
+
+def verify_torrents(torrents, jobs=None):
+    ''' Verifies the data of the specified (key, info, path) torrents in
+        parallel. Yields (key, npieces, bad pieces) for each torrent, in
+        the order the torrents were given.
+    '''
+    with concurrent.futures.ProcessPoolExecutor(jobs) as pool:
+        pending = {}
+        for key, info, path in torrents:
+            files = torrent_files(info, path)
+            pieces = btcodec.to_bytes(info['pieces'])
+            npieces = len(pieces) // 20
+            segments = piece_segments(files, info['piece length'])
+            futures = []
+            for first in range(0, npieces, PIECE_BATCH):
+                last = min(first + PIECE_BATCH, npieces)
+                hashes = [pieces[20*p:20*(p+1)] for p in range(first, last)]
+                batch = list(itertools.islice(segments, last - first))
+                futures.append(pool.submit(check_pieces, first, hashes, batch))
+            pending[key] = (npieces, futures)
+            if not futures:
+                yield key, 0, []
+                del pending[key]
+
+        for key, (npieces, futures) in pending.items():
+            bad = []
+            for future in futures:
+                bad.extend(future.result())
+            yield key, npieces, sorted(bad)
+
+def verify_torrent(info, path, jobs=None):
+    ''' Verifies the data of a single torrent.
+        Returns the number of pieces and the list of bad pieces.
+    '''
+    for _, npieces, bad in verify_torrents([(None, info, path)], jobs):
+        return npieces, bad
+
+
+###############################################################################
+#### Real action ##############################################################
+###############################################################################
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='''Verify bit torrent data against the piece hashes of a .torrent file.
+    ''')
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+        help='number of processes to use for hashing (default: number of cpus)',
+    )
+    parser.add_argument('-v', '--verbose', action='store_true', help='list the bad pieces')
+    parser.add_argument('torrent', metavar='TORRENT', help='.torrent file')
+    parser.add_argument('path', metavar='PATH',
+        help='downloaded data (the file itself for single file torrents)',
+    )
+    args = parser.parse_args()
+
+    info = load_info(args.torrent)
+    npieces, bad = verify_torrent(info, args.path, args.jobs)
+
+    print('%s: %.1f%% complete, %d/%d pieces bad' % (
+        args.path, 100.0 * (npieces - len(bad)) / npieces if npieces else 100.0, len(bad), npieces,
+    ))
+    if args.verbose and bad:
+        print('Bad pieces: %s' % (' '.join(map(str, bad))))
+    sys.exit(1 if bad else 0)
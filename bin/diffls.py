@@ -6,12 +6,438 @@
 '''
 
 import argparse
+import collections
+import concurrent.futures
+import contextlib
+import functools
+import hashlib
+import heapq
+import itertools
+import os
 import pathlib
+import pickle
+import sys
+import tempfile
 import difflib
+from array import array
 
 import logging
 logging.basicConfig(format='%(levelname)s: %(message)s', level=logging.INFO)
 
+CACHE_PATH = os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'), 'cliutils', 'diffls')
+
+
+class FuzzyIndex(object):
+    ''' Index of names for finding close matches, ranked the same way as
+        difflib.get_close_matches().
+
+        Names are indexed by their character counts: for each character c
+        and count k, the ids of the names containing c at least k times are
+        kept. Summing over the characters of a query gives the size of the
+        multiset intersection of each name with the query, from which the
+        SequenceMatcher.quick_ratio() of the name follows. quick_ratio() is
+        an upper bound of ratio(), so the full ratio() is only computed for
+        names in decreasing order of their bound, until no remaining name
+        can make it to the results.
+    '''
+    def __init__(self, names=()):
+        self.names = []
+        self.values = []
+        self.postings = collections.defaultdict(functools.partial(array, 'i'))
+        self.removed = set()
+        for name in names:
+            self.add(name)
+
+    def add(self, name, value=None, sig=None):
+        ''' Adds name to the index. value is returned along with name when
+            it matches, and defaults to name. sig is the signature() of name,
+            if already known.
+        '''
+        i = len(self.names)
+        self.names.append(name)
+        self.values.append(name if value is None else value)
+        for c, k in (sig if sig is not None else signature(name)):
+            for j in range(k):
+                self.postings[c, j].append(i)
+
+    def remove(self, ids):
+        ''' Removes the names with the specified ids from the index.
+            Their ids are not reused.
+        '''
+        self.removed.update(ids)
+
+    def __len__(self):
+        return len(self.names) - len(self.removed)
+
+    def close_matches(self, word, n=3, cutoff=0.6, exclude=()):
+        ''' Returns the best (score, name, value) matches for word, as in
+            difflib.get_close_matches(word, names, n, cutoff), skipping the
+            names in exclude. Ties are resolved the same way.
+        '''
+        # size of the character multiset intersection of each name with word
+        common = collections.Counter(itertools.chain.from_iterable(
+            self.postings.get((c, j), ()) for c, k in collections.Counter(word).items() for j in range(k)
+        ))
+        lw = len(word)
+        bounds = sorted(((2.0 * m / (len(self.names[i]) + lw), i) for i, m in common.items()
+            if i not in self.removed), key=lambda b: (-b[0], b[1]))
+
+        s = difflib.SequenceMatcher()
+        s.set_seq2(word)
+        result = []  # heap of the best n (score, name, -id) tuples
+        for bound, i in bounds:
+            if bound < cutoff or (len(result) == n and bound < result[0][0]):
+                break
+            name = self.names[i]
+            if name in exclude:
+                continue
+            s.set_seq1(name)
+            score = s.ratio()
+            if score >= cutoff:
+                item = (score, name, -i)
+                if len(result) < n:
+                    heapq.heappush(result, item)
+                elif item > result[0]:
+                    heapq.heapreplace(result, item)
+
+        # names sharing no characters with word score 0
+        if cutoff <= 0.0 and (len(result) < n or result[0][0] <= 0.0):
+            for i, name in enumerate(self.names):
+                if i not in common and i not in self.removed and name not in exclude:
+                    item = (0.0 if name or word else 1.0, name, -i)
+                    if len(result) < n:
+                        heapq.heappush(result, item)
+                    elif item > result[0]:
+                        heapq.heapreplace(result, item)
+        return [(score, name, self.values[-i]) for score, name, i in sorted(result, reverse=True)]
+
+def signature(name):
+    ''' Returns the (character, count) pairs of name, by which names are
+        indexed in FuzzyIndex.
+    '''
+    return tuple(collections.Counter(name).items())
+
+# (name, path relative to the scanned root, is_dir, is_file, signature of name)
+Entry = collections.namedtuple('Entry', 'name relpath is_dir is_file sig')
+
+def _list_dir(root, relpath):
+    ''' Lists root/relpath with os.scandir(). Entry types come from the
+        directory entries (d_type), so only symlinks need a stat.
+        Returns the entries and the relative paths of the subdirectories,
+        not following symlinks.
+    '''
+    entries, subdirs = [], []
+    with os.scandir(os.path.join(root, relpath)) as it:
+        for e in it:
+            rel = os.path.join(relpath, e.name)
+            entries.append(Entry(e.name, rel, e.is_dir(), e.is_file(), signature(e.name)))
+            if e.is_dir(follow_symlinks=False):
+                subdirs.append(rel)
+    return entries, subdirs
+
+def scan_dir(root, recursive=False, keep_hidden=False, jobs=None, cache=None):
+    ''' Scans directory root, yielding lists of entries as each directory
+        is listed. With recursive, subdirectories are listed concurrently
+        over a thread pool. Hidden subdirectories are skipped, unless
+        keep_hidden is set. Unreadable subdirectories are skipped with a
+        warning. If a DirCache for root is given, directories are listed
+        through it.
+    '''
+    list_dir = cache.list_dir if cache is not None else lambda relpath: _list_dir(root, relpath)
+    if not recursive:
+        yield list_dir('')[0]
+        return
+    with concurrent.futures.ThreadPoolExecutor(jobs) as pool:
+        pending = {pool.submit(list_dir, '')}
+        while pending:
+            done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                try:
+                    entries, subdirs = future.result()
+                except OSError as e:
+                    logging.warning('Skipping "%s". %s.', e.filename, e.strerror)
+                    continue
+                for d in subdirs:
+                    if keep_hidden or not os.path.basename(d).startswith('.'):
+                        pending.add(pool.submit(list_dir, d))
+                yield entries
+
+def build_index(scan, accept=None):
+    ''' Returns a FuzzyIndex of the names of the entries yielded by scan,
+        as lists, for which accept(entry) is true. Matches return the
+        relative path of the entry.
+    '''
+    index = FuzzyIndex()
+    for entries in scan:
+        for it in entries:
+            if accept is None or accept(it):
+                index.add(it.name, it.relpath, it.sig)
+    return index
+
+
+###############################################################################
+#### Index cache ##############################################################
+###############################################################################
+class DirCache(object):
+    ''' On-disk cache of the index of the names under directory root, for
+        the scan options and filter identified by key, stored in cache_path.
+
+        Along with the index, the mtime and inode (stamp) and subdirectories
+        of each scanned directory are stored, as well as the ids of its names
+        in the index. While none of the stamps changes, the index is reused
+        without listing any directory. Otherwise, only the directories that
+        changed are listed again, replacing their names in the index.
+
+        Only builtin types are pickled, so that the cache can be shared by
+        the scripts importing this module.
+    '''
+    VERSION = 1
+
+    def __init__(self, root, key, cache_path=CACHE_PATH):
+        self.root = os.path.abspath(root)
+        self.filename = os.path.join(cache_path, '%s.%s.pickle' % (
+            hashlib.sha1(os.fsencode(self.root)).hexdigest()[:16], key))
+        self.dirs = {}      # relpath -> (stamp, subdirs)
+        self.ranges = {}    # relpath -> (first, last) ids of its names in the index
+        self.index = FuzzyIndex()
+        self.seen = set()   # directories found by the last scan
+        self.listed = set() # directories listed by the last scan
+        self.load()
+
+    def _stamp(self, relpath):
+        st = os.stat(os.path.join(self.root, relpath))
+        return st.st_mtime_ns, st.st_ino, st.st_dev
+
+    def load(self):
+        ''' Loads the cached index, if there is one.'''
+        try:
+            with open(self.filename, 'rb') as f:
+                version, root, state = pickle.load(f)
+            if version != self.VERSION or root != self.root:
+                return
+            dirs, ranges, (names, values, postings, removed) = state
+        except (OSError, EOFError, ValueError, TypeError, AttributeError, pickle.UnpicklingError):
+            return
+        self.dirs, self.ranges = dirs, ranges
+        self.index.names, self.index.values, self.index.postings, self.index.removed = names, values, postings, removed
+
+    def save(self):
+        ''' Atomically writes the index to the cache.'''
+        index = self.index
+        state = (self.dirs, self.ranges, (index.names, index.values, index.postings, index.removed))
+        os.makedirs(os.path.dirname(self.filename), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(self.filename), prefix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump((self.VERSION, self.root, state), f, pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp, self.filename)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+
+    def list_dir(self, relpath):
+        ''' Lists root/relpath like _list_dir(), if it changed since it was
+            cached. Otherwise, no entries are returned, along with the cached
+            subdirectories. Safe to call from threads.
+        '''
+        # the stamp is taken before listing, so that changes made while
+        # listing invalidate the listing
+        stamp = self._stamp(relpath)
+        self.seen.add(relpath)
+        cached = self.dirs.get(relpath)
+        if cached is not None and cached[0] == stamp:
+            return [], cached[1]
+        entries, subdirs = _list_dir(self.root, relpath)
+        self.dirs[relpath] = (stamp, subdirs)
+        self.listed.add(relpath)
+        return entries, subdirs
+
+    def is_valid(self, jobs=None):
+        ''' Returns whether none of the cached directories changed.'''
+        def unchanged(item):
+            try:
+                return self._stamp(item[0]) == item[1][0]
+            except OSError:
+                return False
+        if len(self.dirs) == 1:
+            return unchanged(next(iter(self.dirs.items())))
+        with concurrent.futures.ThreadPoolExecutor(jobs) as pool:
+            return all(pool.map(unchanged, self.dirs.items()))
+
+    def update(self, recursive=False, keep_hidden=False, jobs=None, accept=None):
+        ''' Brings the index up to date with the directories under root,
+            scanned as with scan_dir(). Only the entries for which
+            accept(entry) is true are indexed.
+            Returns whether the index was changed.
+        '''
+        if self.dirs and self.is_valid(jobs):
+            return False
+
+        self.seen, self.listed = set(), set()
+        ranges = {}
+        for entries in scan_dir(self.root, recursive, keep_hidden, jobs, self):
+            if entries:
+                first = len(self.index.names)
+                for it in entries:
+                    if accept is None or accept(it):
+                        self.index.add(it.name, it.relpath, it.sig)
+                ranges[os.path.dirname(entries[0].relpath)] = (first, len(self.index.names))
+
+        # drop the old names of the listed directories and of the
+        # directories that are gone
+        for d, (first, last) in self.ranges.items():
+            if d in self.listed or d not in self.seen:
+                self.index.remove(range(first, last))
+            else:
+                ranges[d] = (first, last)
+        self.ranges = ranges
+        self.dirs = {d: v for d, v in self.dirs.items() if d in self.seen}
+        if len(self.index.removed) > len(self.index):
+            self.compact()
+        return True
+
+    def compact(self):
+        ''' Rebuilds the index without the removed names.'''
+        index = FuzzyIndex()
+        ranges = {}
+        for d, (first, last) in sorted(self.ranges.items(), key=lambda r: r[1]):
+            ranges[d] = (len(index.names), len(index.names) + last - first)
+            for i in range(first, last):
+                index.add(self.index.names[i], self.index.values[i])
+        self.index, self.ranges = index, ranges
+
+def dir_index(d, recursive=False, keep_hidden=False, only_dirs=False, only_files=False, jobs=None,
+        cache_path=CACHE_PATH):
+    ''' Returns a FuzzyIndex of the entries of directory d, filtered by
+        the flags. The index is taken from the index cache in cache_path,
+        unless cache_path is None.
+    '''
+    accept = lambda it: not (
+        (not keep_hidden and it.name.startswith('.')) or
+        (only_dirs and not it.is_dir) or
+        (only_files and not it.is_file)
+    )
+    if cache_path is None:
+        return build_index(scan_dir(d, recursive, keep_hidden, jobs), accept)
+
+    key = '%s%s%s' % ('r' if recursive else '-', 'h' if keep_hidden else '-',
+        'd' if only_dirs else 'f' if only_files else '-')
+    cache = DirCache(d, key, cache_path)
+    if cache.update(recursive, keep_hidden, jobs, accept):
+        try:
+            cache.save()
+        except OSError as e:
+            logging.warning('Could not update the index cache for "%s". %s.', d, e.strerror)
+    return cache.index
+
+
+###############################################################################
+#### Batch mode ###############################################################
+###############################################################################
+POOL_MIN_REFS = 256  # each worker gets a copy of the indexes, only worth it for many refs
+POOL_CHUNK_REFS = 32
+
+_indexes = None  # (directory, index) pairs searched by the pool workers
+
+def _init_worker(indexes):
+    global _indexes
+    _indexes = indexes
+
+def best_matches(ref, indexes, n=3, cutoff=0.6, keep_exact=False):
+    ''' Returns the best (score, path) matches for the name of ref in the
+        (directory, index) pairs of indexes, best first.
+    '''
+    name = pathlib.PurePath(ref).name
+    exclude = () if keep_exact else (name,)
+    matches = []
+    for p, index in indexes:
+        matches.extend((score, str(p / f)) for score, _, f in index.close_matches(name, n, cutoff, exclude))
+    matches.sort(key=lambda m: -m[0])
+    return matches[:n]
+
+def _best_matches(ref, n, cutoff, keep_exact):
+    return best_matches(ref, _indexes, n, cutoff, keep_exact)
+
+def match_batch(refs, indexes, n=3, cutoff=0.6, keep_exact=False, jobs=None):
+    ''' Yields the best_matches() of each of refs, in order. Many refs are
+        matched over a process pool, with a copy of indexes in each worker.
+    '''
+    if len(refs) < POOL_MIN_REFS:
+        for ref in refs:
+            yield best_matches(ref, indexes, n, cutoff, keep_exact)
+        return
+    work = functools.partial(_best_matches, n=n, cutoff=cutoff, keep_exact=keep_exact)
+    with concurrent.futures.ProcessPoolExecutor(jobs, initializer=_init_worker, initargs=(indexes,)) as pool:
+        yield from pool.map(work, refs, chunksize=POOL_CHUNK_REFS)
+
+def assign_optimal(pairs):
+    ''' Pairs each a with at most one b, out of the candidate (score, a, b)
+        pairs, maximizing the total score of the chosen pairs. Each a may
+        also stay unpaired, at a score of 0.
+        The assignment is solved by successive shortest augmenting paths
+        (Dijkstra with node potentials) over the candidate pairs only, so
+        each search stays within the candidates reachable from its a.
+        Returns the chosen pairs, highest scores first.
+    '''
+    edges = collections.defaultdict(dict)  # a -> {b: score}
+    for score, a, b in pairs:
+        if score > edges[a].get(b, 0.0):
+            edges[a][b] = score
+    # reduced costs pa[a] - score - pb[b] are kept non-negative, and zero
+    # for the pairs in the matching
+    pa = {a: max(bs.values(), default=0.0) for a, bs in edges.items()}
+    pb = collections.defaultdict(float)
+    match_a, match_b = {}, {}
+    unpaired = object()
+    counter = itertools.count()
+
+    for s in edges:
+        dist = {}                # finalized distances of the b reached
+        dist_a = {s: 0.0}        # distances of the a reached
+        best, prev = {}, {}      # tentative distances of the b, and the a they were reached from
+        heap = []
+        a, d = s, 0.0
+        while True:
+            # the unpaired node of a is free, unless a is already unpaired
+            for b, score in itertools.chain(edges[a].items(), [((unpaired, a), 0.0)]):
+                nd = d + pa[a] - score - pb[b]
+                if b not in dist and nd < best.get(b, float('inf')):
+                    best[b], prev[b] = nd, a
+                    heapq.heappush(heap, (nd, next(counter), b))
+            while True:
+                d, _, b = heapq.heappop(heap)
+                if b not in dist:
+                    break
+            dist[b] = d
+            a = match_b.get(b)
+            if a is None:
+                break
+            dist_a[a] = d
+
+        # shift the potentials of the nodes reached, keeping reduced costs
+        # non-negative, then flip the matching along the path to b
+        for x, dx in dist.items():
+            pb[x] += dx - d
+        for x, dx in dist_a.items():
+            pa[x] += dx - d
+        while True:
+            a = prev[b]
+            b_old = match_a.get(a)
+            match_a[a], match_b[b] = b, a
+            if a == s:
+                break
+            b = b_old
+
+    chosen = [(edges[a][b], a, b) for a, b in match_a.items() if b != (unpaired, a)]
+    chosen.sort(key=lambda p: -p[0])
+    return chosen
+
+def read_refs(filename):
+    ''' Returns the non-empty lines of filename, or of stdin for "-".'''
+    with (open(filename) if filename != '-' else contextlib.nullcontext(sys.stdin)) as f:
+        return [l.rstrip('\n') for l in f if l.strip()]
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='''List files by lexicographical proximity.
     ''')
@@ -32,15 +458,41 @@ if __name__ == '__main__':
     match_type_parser = parser.add_mutually_exclusive_group()
     match_type_parser.add_argument('--only-files', action='store_true', help='match only files')
     match_type_parser.add_argument('--only-dirs', action='store_true', help='match only dirs')
+    parser.add_argument('-r', '--recursive', action='store_true', help='search directories recursively')
+    parser.add_argument('-j', '--jobs',
+        action='store', dest='jobs', type=int, default=None,
+        help='number of threads for scanning directories recursively, and of processes in batch mode',
+    )
 
-    parser.add_argument('ref', metavar='REF', help='reference file')
-    parser.add_argument('dirs', metavar='DIR', nargs='+', help='directories to search')
+    parser.add_argument('--cache-dir',
+        action='store', dest='cache_dir', default=CACHE_PATH,
+        help='directory for the index cache (default: %s)' % (CACHE_PATH),
+    )
+    parser.add_argument('--no-cache', action='store_true', help="don't use or update the index cache")
+
+    parser.add_argument('-b', '--batch',
+        action='store', dest='batch', metavar='FILE',
+        help='match each of the references listed in FILE ("-" for stdin) instead of REF, '
+            'printing ref, match and score as TSV',
+    )
+    parser.add_argument('--one-to-one', action='store_true',
+        help='in batch mode, match each reference and each file at most once, '
+            'choosing among the NRESULTS best matches of each reference the pairs '
+            'with the highest total score',
+    )
+
+    parser.add_argument('ref', metavar='REF', help='reference file (omitted in batch mode)')
+    parser.add_argument('dirs', metavar='DIR', nargs='*', help='directories to search')
 
     args = parser.parse_args()
     logging.debug(args)
 
-    ref = pathlib.Path(args.ref)
-    for d in args.dirs:
+    dirs = args.dirs if args.batch is None else [args.ref] + args.dirs
+    if not dirs:
+        parser.error('no directories to search')
+
+    indexes = []
+    for d in dirs:
         p = pathlib.Path(d)
         if not p.exists():
             logging.warning('Skipping "%s". Does not exist.', p)
@@ -49,19 +501,32 @@ if __name__ == '__main__':
             logging.warning('Skipping "%s". Not a directory.', p)
             continue
 
-        # get directory contents and filter out results based on flags
-        contents = [it.name for it in p.iterdir()
-            if not (
-                (not args.keep_exact and it.name == ref.name) or
-                (not args.keep_hidden and it.name.startswith('.')) or
-                (args.only_dirs and not it.is_dir()) or
-                (args.only_files and not it.is_file())
-            )
-        ]
+        # index directory contents as they are scanned and filter out
+        # results based on flags
+        index = dir_index(d, args.recursive, args.keep_hidden, args.only_dirs, args.only_files, args.jobs,
+            None if args.no_cache else args.cache_dir)
+        if args.batch is not None:
+            indexes.append((p, index))
+            continue
 
         # get and print close matches
-        matches = difflib.get_close_matches(ref.name, contents, n=args.n, cutoff=args.cutoff)
-        for f in matches:
+        ref = pathlib.Path(args.ref)
+        exclude = () if args.keep_exact else (ref.name,)
+        for score, _, f in index.close_matches(ref.name, n=args.n, cutoff=args.cutoff, exclude=exclude):
             print(p / f)
 
+    ################################################
+    # Batch mode.
+    ################################################
+    if args.batch is not None:
+        refs = read_refs(args.batch)
+        results = match_batch(refs, indexes, args.n, args.cutoff, args.keep_exact, args.jobs)
+        if args.one_to_one:
+            pairs = [(score, i, f) for i, matches in enumerate(results) for score, f in matches]
+            assigned = {i: (f, score) for score, i, f in assign_optimal(pairs)}
+            results = [[(assigned[i][1], assigned[i][0])] if i in assigned else [] for i in range(len(refs))]
+        for ref, matches in zip(refs, results):
+            for score, f in matches:
+                print('%s\t%s\t%.4f' % (ref, f, score))
+
 # vim: ts=4 sts=4 sw=4 et noai :
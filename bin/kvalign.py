@@ -5,36 +5,84 @@ Align script for key-value text lines.
 Original on: https://github.com/m000/cliutils
 """
 import argparse
+import concurrent.futures
+import functools
+import hashlib
+import itertools
+import shutil
 import string
 import sys
 import os
+import tempfile
+import time
+from array import array
+
+CHUNK_SIZE = 512
 
 # RULER = ''.join(['|' if not i % 10 else ( '+' if not i % 5 else '.' ) for i in range(81)])
 
-def get_spacing(lines, sep, maxsplit=-1):
-    # calculate the number of columns
-    if maxsplit == -1:
-        ncols = max([l.count(sep) for l in lines]) + 1
-    else:
-        ncols = maxsplit + 1
+class ColumnStats(object):
+    # single pass indent and column width statistics for key-value lines
+    # lines are processed in chunks - each chunk is split and transposed to
+    # columns, so the widths of a column are updated in one go
+    def __init__(self, sep, maxsplit=-1):
+        self.sep = sep
+        self.maxsplit = maxsplit
+        self.indent = 0
+        self.colw = array("l", (maxsplit + 1 if maxsplit != -1 else 1) * [0])
 
-    # leading indentation and column widths
-    indent = 0
-    colw = ncols * [0]
+    def update(self, chunk):
+        # split lines - single column lines are skipped
+        multi, rows = [], []
+        for l in chunk:
+            components = l.split(self.sep, self.maxsplit)
+            if len(components) > 1:
+                multi.append(l)
+                rows.append(components)
+        if not rows:
+            return self
 
-    # run through the lines to calculate indent and colw
-    for l in lines:
-        # current line column widths - single column lines are skipped
-        lw = list(map(lambda s: len(s.strip()), l.split(sep, ncols - 1)))
-        if len(lw) == 1:
-            continue
-        lw.extend((ncols - len(lw)) * [0])
+        # update indent and colw - stripping can be skipped for columns
+        # that are not wider than colw even before stripping
+        colw = self.colw
+        self.indent = max(self.indent, max([len(l) - len(l.lstrip(" ")) for l in multi]))
+        for i, column in enumerate(itertools.zip_longest(*rows, fillvalue="")):
+            if i < len(colw) and max(map(len, column)) <= colw[i]:
+                continue
+            w = max(map(len, map(str.strip, column)))
+            if i >= len(colw):
+                colw.append(w)
+            elif w > colw[i]:
+                colw[i] = w
+        return self
+
+    def update_all(self, lines, chunksize=CHUNK_SIZE):
+        # lines can be any iterable (e.g. a file) - it is only traversed once
+        lines = iter(lines)
+        while True:
+            chunk = list(itertools.islice(lines, chunksize))
+            if not chunk:
+                return self
+            self.update(chunk)
+
+    def spacing(self):
+        return (self.indent, list(self.colw))
 
-        # update indent and colw
-        indent = max(indent, len(l) - len(l.lstrip(" ")))
-        colw = map(max, zip(colw, lw))
+def get_spacing(lines, sep, maxsplit=-1, chunksize=CHUNK_SIZE):
+    # leading indentation and column widths
+    return ColumnStats(sep, maxsplit).update_all(lines, chunksize).spacing()
 
-    return (indent, list(colw))
+def get_blocks(lines, window=0):
+    # split lines into blocks of window lines, or into blocks ending
+    # at blank lines if window is 0
+    block = []
+    for l in lines:
+        block.append(l)
+        if (len(block) == window) if window else not l.strip():
+            yield block
+            block = []
+    if block:
+        yield block
 
 def reformat_lines(lines, sep, colw, indent=0,
         space_before=1, space_after=1, gravity='w', file=sys.stdout):
@@ -42,22 +90,140 @@ def reformat_lines(lines, sep, colw, indent=0,
     ncols = len(colw)
     stripc = string.whitespace + sep
     delim = space_before*' ' + sep + space_after*' '
+    indent = indent*" "
+    spaces = max(colw, default=0)*" "
+
+    # fixed-width template for lines with all ncols columns - each cell is
+    # padded by str.format(), with east gravity padding the cell itself and
+    # west gravity padding the cell joined with its delimiter
+    if gravity == 'e':
+        escaped = delim.replace("{", "{{").replace("}", "}}")
+        template = indent + "".join("{:<%d}%s" % (w, escaped) if w else "{}" + escaped for w in colw)
+    else:
+        template = indent + "".join("{:<%d}" % (w + len(delim)) for w in colw)
 
+    # output is written in batches of lines
+    batch = []
     for l in lines:
-        components_in = l.split(sep, ncols - 1)
-        components_out = [indent*" ",]
-        if l[0] == sep or len(components_in) == 1:
+        components = l.split(sep, ncols - 1)
+        if l[0] == sep or len(components) == 1:
             # don't process lines starting with sep, or not containing sep
-            components_out.append(l.rstrip(stripc))
+            out = indent + l.rstrip(stripc)
+        elif len(components) == ncols:
+            if gravity == 'e':
+                out = template.format(*map(str.strip, components))
+            else:
+                out = template.format(*[c.strip() + delim for c in components])
         else:
-            for i, c in enumerate(components_in):
+            # lines with fewer columns are padded using the precomputed spaces
+            out = [indent]
+            for w, c in zip(colw, components):
                 c = c.strip()
                 if gravity == 'e':
-                    fmt = "{:<}{:>%d}" % (colw[i]-len(c)+len(delim))
+                    out.extend((c, spaces[:max(w-len(c), 0)], delim))
                 else:
-                    fmt = "{:<}{:<%d}" % (colw[i]-len(c)+len(delim))
-                components_out.append(fmt.format(c, delim))
-        print("".join(components_out).rstrip(stripc), file=file)
+                    out.extend((c, delim, spaces[:max(w-len(c), 0)]))
+            out = "".join(out)
+        batch.append(out.rstrip(stripc))
+        if len(batch) >= CHUNK_SIZE:
+            batch.append("")
+            file.write("\n".join(batch))
+            batch = []
+    if batch:
+        batch.append("")
+        file.write("\n".join(batch))
+
+def read_lines(f, sep, window=None):
+    # returns the lines of f, their spacing and newline convention
+    # seekable inputs are read twice instead of being kept in memory: once
+    # to get the line spacing and once to reformat them - in window mode
+    # spacing is calculated per block, so lines are returned as they are
+    if window is not None:
+        return f, None, os.linesep
+    if f.seekable():
+        start = f.tell()
+        spacing = get_spacing(f, sep)
+        newlines = f.newlines
+        f.seek(start)
+        lines = f
+    else:
+        lines = f.readlines()
+        newlines = f.newlines
+        spacing = get_spacing(lines, sep)
+    # the newlines of the input are known once it has been read
+    return lines, spacing, newlines if isinstance(newlines, str) else None
+
+def align_lines(lines, spacing, sep, indent=-1, window=None, file=sys.stdout, **fmt_args):
+    # reformat lines using their spacing, or each block in window mode
+    if window is None:
+        blocks = [(lines, spacing)]
+    else:
+        blocks = ((block, get_spacing(block, sep)) for block in get_blocks(lines, window))
+    for block, (bindent, colw) in blocks:
+        reformat_lines(block, sep, colw, indent=bindent if indent < 0 else indent,
+                file=file, **fmt_args)
+        file.flush()
+
+def file_digest(path):
+    h = hashlib.blake2b()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.digest()
+
+def align_file(path, sep, indent=-1, window=None, **fmt_args):
+    # align path in place - the output goes to a temp file, which replaces
+    # path only if its contents differ, so aligned files are left untouched
+    # returns whether path was rewritten
+    with open(path, "r") as f:
+        lines, spacing, linesep = read_lines(f, sep, window)
+        with tempfile.NamedTemporaryFile("w", dir=os.path.dirname(os.path.abspath(path)),
+                prefix=".%s." % os.path.basename(path), delete=False, newline=linesep) as out:
+            try:
+                align_lines(lines, spacing, sep, indent, window, file=out, **fmt_args)
+            except BaseException:
+                out.close()
+                os.remove(out.name)
+                raise
+    if file_digest(out.name) == file_digest(path):
+        os.remove(out.name)
+        return False
+    shutil.copymode(path, out.name)
+    os.replace(out.name, path)
+    return True
+
+def _align_file(path, **kwargs):
+    # pool worker - returns the path, whether it was rewritten and any error
+    try:
+        return path, align_file(path, **kwargs), None
+    except (OSError, UnicodeDecodeError) as e:
+        return path, False, e
+
+def expand_paths(paths):
+    # expand directories to the non-hidden files below them
+    for p in paths:
+        if not os.path.isdir(p):
+            yield p
+            continue
+        for root, dirs, files in os.walk(p):
+            dirs[:] = sorted(d for d in dirs if not d.startswith("."))
+            for name in sorted(files):
+                if not name.startswith("."):
+                    yield os.path.join(root, name)
+
+def benchmark(nlines, sep=":", file=sys.stderr):
+    # time the alignment stages over synthetic key-value lines
+    keys = ["key", "name", "a_much_longer_key", "x"]
+    lines = ["%s%s %s %s%s %d\n" % (" " * (i % 5), keys[i % len(keys)], sep, "v" * (i * 7 % 31), sep, i)
+            for i in range(nlines)]
+    t0 = time.perf_counter()
+    indent, colw = get_spacing(lines, sep)
+    t1 = time.perf_counter()
+    with open(os.devnull, "w") as devnull:
+        reformat_lines(lines, sep, colw, indent=indent, file=devnull)
+    t2 = time.perf_counter()
+    for stage, t in (("get_spacing", t1 - t0), ("reformat_lines", t2 - t1)):
+        print("%-16s %8.3fs %12.0f lines/s" % (stage, t, nlines / t if t else float("inf")), file=file)
 
 ###############################################################################
 #### Real action ##############################################################
@@ -76,39 +242,61 @@ if __name__ == "__main__":
             help="gravity direction - pulls the separator")
     parser.add_argument("-i", "--indent", type=int, default=-1,
             help="indent space width")
+    parser.add_argument("-w", "--window", type=int, default=None,
+            help="align blocks of WINDOW lines separately, or blocks separated by blank lines if 0 - "
+                "output is flushed after each block, so memory use is bounded")
     output_mode = parser.add_mutually_exclusive_group()
     output_mode.add_argument("-o", "--output", default=None,
             help="output file")
     output_mode.add_argument("--in-place", action="store_true", default=False,
-            help="edit input in place")
-    parser.add_argument("input", nargs="?", help="input file")
+            help="edit input in place - files that are already aligned are not rewritten")
+    parser.add_argument("-j", "--jobs", type=int, default=None,
+            help="number of processes for editing multiple files in place (default: number of cpus)")
+    parser.add_argument("--benchmark", type=int, default=None, metavar="NLINES",
+            help="time the alignment of NLINES synthetic lines and exit")
+    parser.add_argument("input", nargs="*",
+            help="input file - multiple files or directories can be edited in place")
     args = parser.parse_args()
+    if args.benchmark is not None:
+        benchmark(args.benchmark, args.sep)
+        sys.exit(0)
+    if args.in_place and not args.input:
+        parser.error("--in-place requires an input file")
+    if not args.in_place and (len(args.input) > 1 or any(map(os.path.isdir, args.input))):
+        parser.error("multiple inputs require --in-place")
+    fmt_args = dict(space_before=args.space_before, space_after=args.space_after, gravity=args.gravity)
+    align_args = dict(sep=args.sep, indent=args.indent, window=args.window, **fmt_args)
+
+    # edit in place - multiple files are edited in parallel
+    if args.in_place:
+        paths = list(expand_paths(args.input))
+        if len(paths) == 1:
+            results = [_align_file(paths[0], **align_args)]
+        else:
+            with concurrent.futures.ProcessPoolExecutor(args.jobs) as pool:
+                results = list(pool.map(functools.partial(_align_file, **align_args), paths, chunksize=8))
+        failed = 0
+        for path, rewritten, error in results:
+            if error is not None:
+                print("%s: %s" % (path, error), file=sys.stderr)
+                failed += 1
+            elif rewritten and len(paths) > 1:
+                print("aligned %s" % (path), file=sys.stderr)
+        sys.exit(1 if failed else 0)
 
     # read lines
-    if args.input is None:
-        lines = sys.stdin.readlines()
+    f = sys.stdin if not args.input else open(args.input[0], "r")
+    lines, spacing, linesep = read_lines(f, args.sep, args.window)
+    if not args.input:
         linesep = os.linesep
-    else:
-        with open(args.input, "rU") as f:
-            lines = f.readlines()
-            linesep = f.newlines
-
-    # get line spacing
-    indent, colw = get_spacing(lines, args.sep)
-
-    # fix arguments
-    args.output = args.output if not args.in_place else args.input
-    args.indent = indent if args.indent < 0 else args.indent
 
     # reformat and print
-    if args.output is None:
-        reformat_lines(lines, args.sep, colw, indent=args.indent,
-                space_before=args.space_before, space_after=args.space_after,
-                gravity=args.gravity)
-    else:
-        with open(args.output, "w", newline=linesep) as f:
-            reformat_lines(lines, args.sep, colw, indent=args.indent,
-                    space_before=args.space_before, space_after=args.space_after,
-                    gravity=args.gravity, file=f)
+    out = sys.stdout if args.output is None else open(args.output, "w", newline=linesep)
+    try:
+        align_lines(lines, spacing, file=out, **align_args)
+    finally:
+        f.close()
+        if out is not sys.stdout:
+            out.close()
 
 # vim: ts=4 sts=4 sw=4 et noai :
@@ -6,12 +6,23 @@
 '''
 
 import argparse
+import collections
+import heapq
+import math
+import os
 import pathlib
+import re
+import time
 import difflib
 
 import logging
 logging.basicConfig(format='%(levelname)s: %(message)s', level=logging.INFO)
 
+from diffls import FuzzyIndex, assign_optimal
+from moveutils import MoveJournal
+
+JOURNAL_SYNC_EVERY = 64  # renames between syncs of the journal
+
 def do_confirm(prompt_text=None, default_response=False):
     prompt_text = prompt_text if prompt_text is not None else 'Confirm'
     prompt_fmt = '%s [%s]|%s: ' if default_response else '%s %s|[%s]: '
@@ -28,59 +39,334 @@ def do_confirm(prompt_text=None, default_response=False):
         else:
             logging.error('Invalid answer: %s', answer)
 
+NGRAM = 3               # length of the n-grams indexed by PairIndex
+MAX_CANDIDATES = 300    # names gathered from the rarest n-grams of a word
+
+def match_key(p):
+    ''' Returns the part of the name of path p compared when pairing:
+        its stem, lowercase, with punctuation collapsed to single spaces.
+    '''
+    return re.sub(r'[\W_]+', ' ', p.stem.lower()).strip()
+
+def ngrams(s):
+    ''' Returns the set of n-grams of s, padded with spaces.'''
+    s = ' %s ' % (s)
+    return {s[i:i+NGRAM] for i in range(len(s) - NGRAM + 1)}
+
+class PairIndex(object):
+    ''' Index of names for finding the best matching names of many words,
+        without comparing each word to each name.
+
+        The names sharing the rarest n-grams of a word, up to a budget, are
+        its candidates. They are ranked by the total IDF weight of all the
+        n-grams they share with the word, so that common n-grams, like the
+        title and season in a list of episodes, still tell apart the names
+        sharing the same rare ones. Candidates are scored by their SequenceMatcher
+        ratio with the word in this order, until one shares less weight
+        than each of the best n found so far. Words with no candidate
+        reaching cutoff are searched in a FuzzyIndex of all names instead.
+    '''
+    def __init__(self, names):
+        self.names = list(names)
+        self.grams = [ngrams(name) for name in self.names]
+        self.postings = collections.defaultdict(list)
+        for i, grams in enumerate(self.grams):
+            for g in grams:
+                self.postings[g].append(i)
+        self.idf = {g: math.log(len(self.names) / len(ids)) for g, ids in self.postings.items()}
+        self.fuzzy = None
+
+    def close_matches(self, word, n=3, cutoff=0.6):
+        ''' Returns the best (score, id) matches for word, as the ratio of
+            SequenceMatcher(None, name, word) and the id of name.
+        '''
+        grams = ngrams(word)
+        candidates = set()
+        for df, g in sorted((len(self.postings[g]), g) for g in grams if g in self.postings):
+            if candidates and len(candidates) + df > MAX_CANDIDATES:
+                break
+            candidates.update(self.postings[g])
+        ranked = sorted(((sum(self.idf[g] for g in grams & self.grams[i]), i) for i in candidates),
+            key=lambda c: (-c[0], c[1]))
+
+        s = difflib.SequenceMatcher()
+        s.set_seq2(word)
+        result = []  # heap of the best n (score, -id, weight) tuples
+        for weight, i in ranked:
+            if len(result) == n and weight < min(r[2] for r in result):
+                break
+            bar = result[0][0] if len(result) == n else cutoff
+            s.set_seq1(self.names[i])
+            if s.real_quick_ratio() >= bar and s.quick_ratio() >= bar:
+                score = s.ratio()
+                if score >= bar:
+                    item = (score, -i, weight)
+                    if len(result) < n:
+                        heapq.heappush(result, item)
+                    elif item > result[0]:
+                        heapq.heapreplace(result, item)
+        if not result:
+            if self.fuzzy is None:
+                self.fuzzy = FuzzyIndex()
+                for i, name in enumerate(self.names):
+                    self.fuzzy.add(name, i)
+            return [(score, i) for score, _, i in self.fuzzy.close_matches(word, n, cutoff)]
+        return [(score, -i) for score, i, _ in sorted(result, reverse=True)]
+
+def auto_pairs(refs, tgts, k=3, cutoff=0.6):
+    ''' Pairs each of the tgts paths with at most one of the refs paths,
+        by the similarity of their names. The k best matching refs of each
+        target are found with a PairIndex, and the pairs are then assigned
+        one-to-one, maximizing the total score.
+        Returns a dict mapping target ids to (score, ref id) tuples.
+    '''
+    index = PairIndex(match_key(refp) for refp in refs)
+    pairs = []
+    for j, tgtp in enumerate(tgts):
+        pairs.extend((score, j, i) for score, i in index.close_matches(match_key(tgtp), k, cutoff))
+    return {j: (score, i) for score, j, i in assign_optimal(pairs)}
+
+class DirNames(object):
+    ''' Names of the entries of directories, listed once per directory with
+        os.scandir(), for checking the existence of many paths.
+    '''
+    def __init__(self):
+        self.dirs = {}
+
+    def names(self, d):
+        ''' Returns the set of names in directory d.'''
+        if d not in self.dirs:
+            try:
+                with os.scandir(d) as it:
+                    self.dirs[d] = {e.name for e in it}
+            except OSError:
+                self.dirs[d] = set()
+        return self.dirs[d]
+
+    def exists(self, p):
+        return p.name in self.names(p.parent)
+
+def rename_target(refp, tgtp, target, args, dirnames, confirm=False, prompt_text=None):
+    ''' Returns the (tgtp, new path) rename of tgtp after refp, according
+        to the options in args, or None. If confirm is set, the user is
+        prompted first.
+    '''
+    # make sure we're trying to rename something that exists
+    if not dirnames.exists(tgtp):
+        for tgtp_alt in [target.parent / tgtp.name, ]:
+            if dirnames.exists(tgtp_alt):
+                tgtp = tgtp_alt
+                break
+        else:
+            logging.error('Could not find target file "%s" to rename.', tgtp)
+            return None
+
+    # construct new file name for target file
+    basename_new = '%s%s%s' % (
+            refp.stem,
+            args.stem if args.stem is not None else '',
+            refp.suffix if args.suffix is None else args.suffix
+    )
+    tgtp_new = tgtp.parent / basename_new
+
+    # rename
+    print('"%s" ->\n\t"%s"' % (tgtp, tgtp_new))
+    rename = (tgtp, tgtp_new) if not confirm or do_confirm(prompt_text) else None
+    if confirm:
+        print('')
+    return rename
+
+
+###############################################################################
+#### Rename planning ##########################################################
+###############################################################################
+def temp_path(p, dirnames):
+    ''' Returns an unused temporary path in the directory of p.'''
+    names = dirnames.names(p.parent)
+    n = 0
+    while '.%s.listrename%d' % (p.name, n) in names:
+        n += 1
+    names.add('.%s.listrename%d' % (p.name, n))
+    return p.parent / ('.%s.listrename%d' % (p.name, n))
+
+def plan_renames(renames, dirnames):
+    ''' Orders the (src, dst) renames so that none overwrites a file.
+        A rename to the source of another rename comes after it, and cycles
+        of renames go through a temporary name. Renames of a source that is
+        already renamed, to a destination that is already taken, or to an
+        existing file that is not renamed, are dropped with an error.
+        Returns the list of (src, dst) renames to execute in order.
+    '''
+    moves = {}  # src -> dst
+    dsts = {}   # dst -> src
+    for src, dst in renames:
+        if src == dst:
+            continue
+        elif src in moves:
+            logging.error('Not renaming "%s" to "%s". Already renamed to "%s".', src, dst, moves[src])
+        elif dst in dsts:
+            logging.error('Not renaming "%s" to "%s". "%s" is renamed to it.', src, dst, dsts[dst])
+        else:
+            moves[src] = dst
+            dsts[dst] = src
+
+    # a destination that exists has to be renamed first, and dropping a
+    # rename takes the rename to its source with it
+    for dst in [dst for dst in dsts if dst not in moves and dirnames.exists(dst)]:
+        src = dsts.pop(dst)
+        logging.error('Not renaming "%s" to "%s". Destination exists.', src, dst)
+        del moves[src]
+        while src in dsts:
+            src, dst = dsts.pop(src), src
+            logging.error('Not renaming "%s" to "%s". Destination is not renamed.', src, dst)
+            del moves[src]
+
+    plan = []
+    ready = collections.deque(src for src, dst in moves.items() if dst not in moves)
+    while moves:
+        if ready:
+            src = ready.popleft()
+            plan.append((src, moves.pop(src)))
+        else:
+            # only cycles are left, open one through a temporary name
+            src = next(iter(moves))
+            tmp = temp_path(src, dirnames)
+            moves[tmp] = moves.pop(src)
+            dsts[moves[tmp]] = tmp
+            plan.append((src, tmp))
+        # src is free now
+        pred = dsts.pop(src, None)
+        if pred is not None:
+            ready.append(pred)
+    return plan
+
+def revert_renames(done, journal, key):
+    ''' Reverts the executed (src, dst) renames in done, latest first,
+        recording them in journal as undone. Returns whether all the
+        renames were reverted.
+    '''
+    try:
+        for src, dst in reversed(done):
+            if os.path.lexists(src):
+                logging.error('Not renaming "%s" back to "%s". Destination exists.', dst, src)
+                return False
+            os.rename(dst, src)
+            journal.record(key, 'undone', src, dst, sync=False)
+        return True
+    except OSError as e:
+        logging.error('Renaming "%s" back to "%s" failed. %s.', dst, src, e.strerror)
+        return False
+    finally:
+        journal.sync()
+
+def execute_renames(plan, journal):
+    ''' Executes the planned (src, dst) renames as a single job recorded
+        in journal. If a rename fails or is interrupted, the executed
+        renames are reverted. Returns whether all the renames were executed.
+    '''
+    # Absolute paths, so that the journal can be undone from any directory.
+    plan = [(os.path.abspath(src), os.path.abspath(dst)) for src, dst in plan]
+    key = str(time.time_ns())
+    journal.record(key, 'queued', moves=plan)
+    done = []
+    try:
+        for src, dst in plan:
+            os.rename(src, dst)
+            done.append((src, dst))
+            journal.record(key, 'moved', src, dst, sync=len(done) % JOURNAL_SYNC_EVERY == 0)
+    except (OSError, KeyboardInterrupt) as e:
+        if isinstance(e, OSError):
+            logging.error('Renaming "%s" to "%s" failed. %s.', src, dst, e.strerror)
+        logging.warning('Reverting %d renames.', len(done))
+        revert_renames(done, journal, key)
+        return False
+    journal.record(key, 'done')
+    return True
+
+def undo_journal(journal):
+    ''' Reverts the renames recorded in journal, latest job first.
+        Renames that were already undone are skipped.
+        Returns whether all the renames were reverted.
+    '''
+    jobs = dict(journal.done)
+    jobs.update(journal.pending)
+    for key in sorted(jobs, key=int, reverse=True):
+        done = [(src, dst) for src, dst in jobs[key] if (key, src, dst, 'moved') in journal and (key, src, dst, 'undone') not in journal]
+        logging.info('Reverting %d renames.', len(done))
+        if not revert_renames(done, journal, key):
+            return False
+    return True
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='''Rename a list of files using another list of files as reference.
     ''')
     parser.add_argument('-i', '--interactive', action='store_true', help="prompt for confirmation of actions")
     parser.add_argument('-a', '--append', action='store', dest='stem', metavar='STEM', help="text to append to the stem of reference files")
     parser.add_argument('-s', '--suffix', action='store', dest='suffix', metavar='SUFFIX', help="text to use instead of the suffix of the reference files")
-    parser.add_argument('reference', metavar='REFERENCE', help='reference list')
-    parser.add_argument('target', metavar='TARGET', help='target list')
+    parser.add_argument('--auto', action='store_true', help="pair targets with references by name similarity, instead of by line")
+    parser.add_argument('-k', '--candidates', action='store', dest='k', type=int, default=3, metavar='K', help="number of best matching references to consider for each target with --auto (default: 3)")
+    parser.add_argument('-c', '--cutoff', action='store', dest='cutoff', type=float, default=0.6, metavar='CUTOFF', help="lowest similarity for pairing with --auto (default: 0.6)")
+    parser.add_argument('--min-score', action='store', dest='min_score', type=float, default=0.8, metavar='SCORE', help="prompt for confirmation of pairs below this similarity with --auto (default: 0.8)")
+    parser.add_argument('--journal', action='store', dest='journal', metavar='JOURNAL', help="journal of the executed renames, for undoing them (default: TARGET.journal)")
+    parser.add_argument('--undo', action='store', dest='undo', metavar='JOURNAL', help="undo the renames recorded in JOURNAL, latest first")
+    parser.add_argument('reference', metavar='REFERENCE', nargs='?', help='reference list')
+    parser.add_argument('target', metavar='TARGET', nargs='?', help='target list')
 
     args = parser.parse_args()
     logging.debug(args)
 
+    if args.undo is not None:
+        journal = MoveJournal(args.undo)
+        ok = undo_journal(journal)
+        journal.close()
+        raise SystemExit(0 if ok else 1)
+    elif args.target is None:
+        parser.error('the following arguments are required: REFERENCE, TARGET')
+
     reference = pathlib.Path(args.reference)
     target = pathlib.Path(args.target)
-    with reference.open() as ref:
+    dirnames = DirNames()
+    renames = []
+    if args.auto:
+        # pair the files by name, rename and leave the rest alone
+        with reference.open() as ref:
+            refs = [pathlib.Path(l.rstrip('\n')) for l in ref if l.strip()]
         with target.open() as tgt:
-            # iterate files and rename
-            for refl, tgtl in zip(ref, tgt):
-                refp = pathlib.Path(refl.rstrip('\n'))
-                tgtp = pathlib.Path(tgtl.rstrip('\n'))
-
-                # make sure we're trying to rename something that exists
-                if not tgtp.exists():
-                    for tgtp_alt in [target.parent / tgtp.name, ]:
-                        if tgtp_alt.exists():
-                            tgtp = tgtp_alt
-                            break
-                    else:
-                        logging.error('Could not find target file "%s" to rename.', tgtp)
-                        continue
-
-                # construct new file name for target file
-                basename_new = '%s%s%s' % (
-                        refp.stem,
-                        args.stem if args.stem is not None else '',
-                        refp.suffix if args.suffix is None else args.suffix
-                )
-                tgtp_new = tgtp.parent / basename_new
-
-                # rename
-                print('"%s" ->\n\t"%s"' % (tgtp, tgtp_new))
-                if not args.interactive or (args.interactive and do_confirm()):
-                    tgtp.rename(tgtp_new)
-                if args.interactive:
-                    print('')
-
-            # check for length mismatch in reference and target lists
-            ref_eof = True if not ref.readline() else False
-            tgt_eof = True if not tgt.readline() else False
-            if ref_eof and not tgt_eof:
-                logging.warning('Reference list shorter than target list.')
-            elif not ref_eof and tgt_eof:
-                logging.warning('Target list shorter than reference list.')
+            tgts = [pathlib.Path(l.rstrip('\n')) for l in tgt if l.strip()]
+        pairs = auto_pairs(refs, tgts, args.k, args.cutoff)
+        for j, tgtp in enumerate(tgts):
+            if j not in pairs:
+                logging.warning('No reference found for target file "%s".', tgtp)
+                continue
+            score, i = pairs[j]
+            confirm = args.interactive or score < args.min_score
+            renames.append(rename_target(refs[i], tgtp, target, args, dirnames, confirm, 'Confirm (score %.2f)' % (score)))
+        if len(pairs) < len(refs):
+            logging.warning('%d reference files were not paired.', len(refs) - len(pairs))
+    else:
+        with reference.open() as ref:
+            with target.open() as tgt:
+                # iterate files and rename
+                for refl, tgtl in zip(ref, tgt):
+                    refp = pathlib.Path(refl.rstrip('\n'))
+                    tgtp = pathlib.Path(tgtl.rstrip('\n'))
+                    renames.append(rename_target(refp, tgtp, target, args, dirnames, args.interactive))
+
+                # check for length mismatch in reference and target lists
+                ref_eof = True if not ref.readline() else False
+                tgt_eof = True if not tgt.readline() else False
+                if ref_eof and not tgt_eof:
+                    logging.warning('Reference list shorter than target list.')
+                elif not ref_eof and tgt_eof:
+                    logging.warning('Target list shorter than reference list.')
+
+    # rename all files in one go, undoing everything on failure
+    plan = plan_renames([r for r in renames if r is not None], dirnames)
+    journal = MoveJournal(args.journal if args.journal else '%s.journal' % (args.target))
+    ok = execute_renames(plan, journal) if plan else True
+    journal.close()
+    if not ok:
+        raise SystemExit(1)
 
 
     #print(list(zip(reference, target)))
@@ -0,0 +1,426 @@
+# -*- coding: utf-8 -*-
+'''
+Helpers for moving large amounts of data around, possibly across
+filesystems, in a way that can be resumed after an interruption.
+
+Original on: https://github.com/m000/cliutils
+'''
+
+import os, sys, shutil, json, time, errno
+import hashlib
+import threading
+import concurrent.futures
+
+
+###############################################################################
+#### Journal ##################################################################
+###############################################################################
+class MoveJournal(object):
+    ''' Append-only journal of move jobs and their completed steps.
+        Each line is a JSON object with the key of a job and a step:
+        'queued' (the moves of the job), 'moved' (renamed in place),
+        'copied' (destination complete, source still there), 'removed'
+        (source removed) or 'done' (all the moves of the job complete).
+        Completed steps are looked up as (key, src, dst, step) tuples.
+        A journal without a filename keeps its records in memory only.
+    '''
+    def __init__(self, filename=None):
+        self.filename = filename
+        self.steps = set()
+        self.queued = {}
+        self.done = {}
+        self._lock = threading.Lock()
+        self._out = None
+        self._terminated = True
+        if filename is None or not os.path.exists(filename):
+            return
+        with open(filename) as journal_in:
+            for line in journal_in:
+                self._terminated = line.endswith('\n')
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # Partially written last line.
+                    continue
+                self._apply(entry)
+
+    def _apply(self, entry):
+        key, step = entry['key'], entry['step']
+        if step == 'queued':
+            self.queued[key] = [tuple(m) for m in entry['moves']]
+        elif step == 'done':
+            self.done[key] = self.queued.pop(key, [])
+        else:
+            self.steps.add((key, entry['src'], entry['dst'], step))
+
+    @property
+    def pending(self):
+        ''' The jobs that were queued but not completed.'''
+        return dict(self.queued)
+
+    def __contains__(self, step):
+        return step in self.steps
+
+    def record(self, key, step, src=None, dst=None, moves=None, sync=True):
+        ''' Appends a step to the journal and, unless sync is False,
+            syncs the journal to disk.
+        '''
+        entry = {'key': key, 'step': step}
+        if step == 'queued':
+            entry['moves'] = moves
+        elif step != 'done':
+            entry.update(src=src, dst=dst)
+        with self._lock:
+            self._apply(entry)
+            if self.filename is None:
+                return
+            if self._out is None:
+                self._out = open(self.filename, 'a')
+                if not self._terminated:
+                    self._out.write('\n')
+            self._out.write(json.dumps(entry) + '\n')
+        if sync:
+            self.sync()
+
+    def sync(self):
+        ''' Syncs the journal to disk.'''
+        with self._lock:
+            if self._out is not None:
+                self._out.flush()
+                os.fsync(self._out.fileno())
+
+    def close(self, remove=False):
+        ''' Closes the journal, optionally removing it.'''
+        if self._out is not None:
+            self._out.close()
+            self._out = None
+        if remove and self.filename is not None:
+            try:
+                os.unlink(self.filename)
+            except FileNotFoundError:
+                pass
+
+
+###############################################################################
+#### Copying ##################################################################
+###############################################################################
+COPY_CHUNK_SIZE = 64 * 1024 * 1024
+READ_CHUNK_SIZE = 8 * 1024 * 1024
+
+# Errors meaning that a kernel-side copy is not possible for these files.
+_NO_KERNEL_COPY = {errno.ENOSYS, errno.EXDEV, errno.EINVAL, errno.EOPNOTSUPP, errno.EBADF, errno.ENOTSUP}
+
+
+class CopyVerifyError(OSError):
+    ''' Raised when a copy does not match its source.'''
+    pass
+
+
+def _kernel_copy(copy, fd_in, fd_out, size, progress):
+    ''' Copies size bytes from fd_in to fd_out using copy(), which is one
+        of os.copy_file_range or os.sendfile. Returns the number of bytes
+        copied, which is 0 if copy() is not supported for these files.
+    '''
+    offset = 0
+    while offset < size:
+        try:
+            if copy is os.sendfile:
+                n = copy(fd_out, fd_in, offset, min(COPY_CHUNK_SIZE, size - offset))
+            else:
+                n = copy(fd_in, fd_out, min(COPY_CHUNK_SIZE, size - offset), offset, offset)
+        except OSError as e:
+            if offset == 0 and e.errno in _NO_KERNEL_COPY:
+                return 0
+            raise
+        if n == 0:
+            break
+        offset += n
+        if progress is not None:
+            progress(n)
+    return offset
+
+def _file_digest(f, buf):
+    ''' Streams the contents of file object f through a hash.'''
+    h = hashlib.blake2b()
+    view = memoryview(buf)
+    while True:
+        n = f.readinto(buf)
+        if not n:
+            return h.digest()
+        h.update(view[:n])
+
+def copy_file(src, dst, progress=None, verify=True):
+    ''' Copies the contents and metadata of the regular file src to dst.
+        Data are copied in the kernel with os.copy_file_range() or
+        os.sendfile() where available, falling back to a buffered copy.
+        Space for dst is preallocated. With verify, src and dst are
+        checksummed afterwards, and CopyVerifyError is raised if they
+        differ. progress is called with the number of bytes copied as
+        the copy proceeds.
+    '''
+    if os.path.islink(src):
+        os.symlink(os.readlink(src), dst)
+        return
+
+    src_digest = None
+    with open(src, 'rb', buffering=0) as f_in, open(dst, 'wb', buffering=0) as f_out:
+        fd_in, fd_out = f_in.fileno(), f_out.fileno()
+        size = os.fstat(fd_in).st_size
+        if size > 0 and hasattr(os, 'posix_fallocate'):
+            try:
+                os.posix_fallocate(fd_out, 0, size)
+            except OSError:
+                pass
+
+        copied = 0
+        for copy in (getattr(os, 'copy_file_range', None), getattr(os, 'sendfile', None)):
+            if copy is not None and copied == 0:
+                copied = _kernel_copy(copy, fd_in, fd_out, size, progress)
+
+        if copied == 0 and size > 0:
+            # Buffered copy. Hash the source on the way.
+            buf = bytearray(READ_CHUNK_SIZE)
+            view = memoryview(buf)
+            h = hashlib.blake2b()
+            while True:
+                n = f_in.readinto(buf)
+                if not n:
+                    break
+                f_out.write(view[:n])
+                h.update(view[:n])
+                if progress is not None:
+                    progress(n)
+            src_digest = h.digest()
+        elif copied < size:
+            raise OSError(errno.EIO, 'Short copy (%d of %d bytes)' % (copied, size), src)
+        os.ftruncate(fd_out, f_in.tell() if copied == 0 else copied)
+
+    shutil.copystat(src, dst)
+    if verify:
+        buf = bytearray(READ_CHUNK_SIZE)
+        if src_digest is None:
+            with open(src, 'rb', buffering=0) as f_in:
+                src_digest = _file_digest(f_in, buf)
+        with open(dst, 'rb', buffering=0) as f_out:
+            dst_digest = _file_digest(f_out, buf)
+        if src_digest != dst_digest:
+            raise CopyVerifyError(errno.EIO, 'Copy does not match source', dst)
+
+
+###############################################################################
+#### Moving ###################################################################
+###############################################################################
+def tree_size(p):
+    ''' Returns the total size of the files under p.'''
+    if not os.path.isdir(p) or os.path.islink(p):
+        return os.lstat(p).st_size
+    size = 0
+    for root, dirs, files in os.walk(p):
+        for f in files:
+            try:
+                size += os.lstat(os.path.join(root, f)).st_size
+            except OSError:
+                pass
+    return size
+
+def format_size(n):
+    ''' Formats a byte count for humans.'''
+    for unit in ['B', 'KiB', 'MiB', 'GiB']:
+        if n < 1024:
+            return '%.1f%s' % (n, unit)
+        n /= 1024.0
+    return '%.1fTiB' % (n)
+
+
+class MoveExecutor(object):
+    ''' Executes a batch of move jobs. Each job consists of one or more
+        (src, dst) moves that are carried out in order.
+        Jobs where all moves stay on the same device only need renames,
+        so they are done first. The remaining jobs are copied over a pool
+        of jobs threads, with at most per_device copies touching any one
+        device at a time. Progress, throughput and ETA of the copies are
+        reported to file.
+        Every completed step goes to the journal, so that an interrupted
+        run can be resumed without repeating the steps already completed.
+    '''
+    PROGRESS_INTERVAL = 5.0
+
+    def __init__(self, journal=None, jobs=4, per_device=2, dryrun=False, verify=True, file=sys.stderr):
+        self.journal = journal if journal is not None else MoveJournal()
+        self.jobs = jobs
+        self.per_device = per_device
+        self.dryrun = dryrun
+        self.verify = verify
+        self.file = file
+        self.queue = []
+        self._lock = threading.Lock()
+        self._semaphores = {}
+        self.bytes_total = 0
+        self.bytes_done = 0
+
+    def add(self, key, moves):
+        ''' Queues a job consisting of the specified (src, dst) moves.'''
+        self.queue.append((key, list(moves)))
+
+    def _completed(self, key, src, dst):
+        return (key, src, dst, 'removed') in self.journal or (key, src, dst, 'moved') in self.journal
+
+    def _device(self, p):
+        ''' Returns the device of p, or of its closest existing parent.'''
+        while True:
+            try:
+                return os.lstat(p).st_dev
+            except FileNotFoundError:
+                if p == os.path.dirname(p):
+                    raise
+                p = os.path.dirname(p)
+
+    def _same_device(self, key, moves):
+        try:
+            return all(self._device(src) == self._device(os.path.dirname(dst))
+                for src, dst in moves if not self._completed(key, src, dst))
+        except OSError:
+            return False
+
+    def _devices(self, moves):
+        devs = set()
+        for src, dst in moves:
+            for p in (src, os.path.dirname(dst)):
+                try:
+                    devs.add(self._device(p))
+                except OSError:
+                    pass
+        return sorted(devs)
+
+    def _progress(self, nbytes):
+        with self._lock:
+            self.bytes_done += nbytes
+
+    def _copy_file(self, src, dst):
+        copy_file(src, dst, progress=self._progress, verify=self.verify)
+
+    def _copy(self, src, dst):
+        ''' Copies src to dst through a temporary partial copy, so that
+            dst only appears when complete.
+        '''
+        partial = os.path.join(os.path.dirname(dst), '.%s.partial' % (os.path.basename(dst)))
+        if os.path.isdir(partial):
+            shutil.rmtree(partial)
+        elif os.path.lexists(partial):
+            os.unlink(partial)
+        if os.path.isdir(src) and not os.path.islink(src):
+            shutil.copytree(src, partial, symlinks=True, copy_function=self._copy_file)
+        else:
+            self._copy_file(src, partial)
+        os.rename(partial, dst)
+
+    def _move(self, key, src, dst):
+        if self._completed(key, src, dst):
+            return
+        if (key, src, dst, 'copied') not in self.journal:
+            os.makedirs(os.path.dirname(dst), exist_ok=True)
+            if os.path.lexists(dst):
+                if not os.path.lexists(src):
+                    # Moved by a run interrupted before journaling it.
+                    self.journal.record(key, 'moved', src, dst)
+                    return
+                raise FileExistsError('Destination path %s already exists' % (dst))
+            try:
+                os.rename(src, dst)
+                self.journal.record(key, 'moved', src, dst)
+                return
+            except OSError as e:
+                if e.errno != errno.EXDEV:
+                    raise
+            self._copy(src, dst)
+            self.journal.record(key, 'copied', src, dst)
+        # The source may be gone already, if removed by a run interrupted
+        # before journaling it.
+        if os.path.isdir(src) and not os.path.islink(src):
+            shutil.rmtree(src)
+        elif os.path.lexists(src):
+            os.unlink(src)
+        self.journal.record(key, 'removed', src, dst)
+
+    def _run_job(self, key, moves, devices=()):
+        semaphores = []
+        with self._lock:
+            for dev in devices:
+                semaphores.append(self._semaphores.setdefault(dev, threading.BoundedSemaphore(self.per_device)))
+        for s in semaphores:
+            s.acquire()
+        try:
+            for src, dst in moves:
+                self._move(key, src, dst)
+        finally:
+            for s in reversed(semaphores):
+                s.release()
+        self.journal.record(key, 'done')
+        return key
+
+    def _report(self, started, ndone, ntotal):
+        elapsed = time.time() - started
+        rate = self.bytes_done / elapsed if elapsed > 0 else 0
+        eta = (self.bytes_total - self.bytes_done) / rate if rate > 0 else float('nan')
+        print('%d/%d copied, %s/%s (%s/s, ETA %s)' % (
+            ndone, ntotal, format_size(self.bytes_done), format_size(self.bytes_total),
+            format_size(rate), time.strftime('%H:%M:%S', time.gmtime(eta)) if eta == eta else '?',
+        ), file=self.file)
+
+    def run(self):
+        ''' Executes the queued jobs, yielding their keys as they complete.
+            Jobs that fail are reported and not yielded. Jobs completed but
+            not yielded, because the caller stopped early, are only in the
+            journal, so it should be kept unless the run finished.
+        '''
+        queue, self.queue = self.queue, []
+        if self.dryrun:
+            for key, _ in queue:
+                yield key
+            return
+
+        for key, moves in queue:
+            if key not in self.journal.done and self.journal.queued.get(key) != moves:
+                self.journal.record(key, 'queued', moves=moves, sync=False)
+        self.journal.sync()
+
+        # Renames are instant - do them first.
+        copies = []
+        for key, moves in queue:
+            if key in self.journal.done:
+                yield key
+            elif self._same_device(key, moves):
+                try:
+                    yield self._run_job(key, moves)
+                except (OSError, shutil.Error) as e:
+                    print('Failed to move %s: %s' % (key, e), file=self.file)
+            else:
+                copies.append((key, moves))
+        if not copies:
+            return
+
+        # Copy the rest in parallel.
+        self.bytes_total = sum(tree_size(src) for key, moves in copies for src, dst in moves
+            if (key, src, dst, 'copied') not in self.journal and os.path.lexists(src))
+        started = time.time()
+        with concurrent.futures.ThreadPoolExecutor(self.jobs) as pool:
+            try:
+                pending = {pool.submit(self._run_job, key, moves, self._devices(moves)): key
+                    for key, moves in copies}
+                ndone = 0
+                while pending:
+                    done, _ = concurrent.futures.wait(pending, timeout=self.PROGRESS_INTERVAL,
+                            return_when=concurrent.futures.FIRST_COMPLETED)
+                    for future in done:
+                        key = pending.pop(future)
+                        ndone += 1
+                        try:
+                            yield future.result()
+                        except (OSError, shutil.Error) as e:
+                            print('Failed to move %s: %s' % (key, e), file=self.file)
+                    self._report(started, ndone, len(copies))
+            finally:
+                # If the caller stops early, the jobs not started yet are
+                # dropped. The running ones complete and are journaled as
+                # done, for the next run to apply.
+                pool.shutdown(wait=True, cancel_futures=True)
@@ -1,4 +1,4 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 # Original on: https://github.com/m000/cliutils
 
@@ -16,6 +16,15 @@ Importing to qBittorrent is a three-step manual process:
     a. Add the .torrent file in paused state.
     b. Force a recheck on the torrent data.
     c. Start the torrent.
+With --verify, the torrent data are checked against their piece hashes
+before moving, and torrents with bad pieces are skipped. Step b can then
+be skipped for the migrated torrents.
+
+With --bt-backup, the manual import is skipped altogether. Each migrated
+torrent is written to qBittorrent's BT_backup directory as <hash>.torrent
+along with a <hash>.fastresume file that carries the save path, category
+and downloaded pieces over from uTorrent. qBittorrent must not be running
+while the files are written.
 
 ** SHUT DOWN uTorrent BEFORE RUNNING **
 
@@ -25,153 +34,122 @@ The ruby script also converts metadata to qBittorrent format and
 imports them.
 '''
 
-from __future__ import print_function
-import os, sys, subprocess, shutil, datetime
-import re, hashlib, argparse
+import os, sys, shutil, datetime
+import json, argparse
+import concurrent.futures
 from pprint import pprint
 
-###############################################################################
-#### Format helpers ###########################################################
-###############################################################################
-def make_hr(text=None, width=None, fill='#'):
-    ''' Creates an ascii horizontal ruler.'''
-    if width is None:
-        try: width = int(subprocess.check_output(['stty', 'size']).split()[1])
-        except: width = 80
-    return ''.ljust(width, fill) if not text else ('%s %s ' % (3*fill, text)).ljust(width, fill)
-
-def print_hr(text=None, width=None, fill='#', file=sys.stdout):
-    ''' Print an ascii horizontal ruler.'''
-    print(make_hr(text, width, fill), file=file)
-
-def print_banner(lines=[], width=None, fill='#', file=sys.stdout):
-    ''' Prints the specified lines in a banner-like format.'''
-    ljust_len = max([len(s) for s in lines])+1
-    print_hr(width=width, fill=fill, file=file)
-    for l in lines:
-        print_hr(l.ljust(ljust_len), width=width, fill=fill, file=file)
-    print_hr(width=width, fill=fill, file=file)
-
-def fit_string(s, width, just='l', fill=' '):
-    ''' Fits string s to the specified width.'''
-    if len(s) > width:
-        scont = '...'
-        ltail = (width-len(scont))/2
-        lhead = width-len(scont)-ltail
-        s = '%s%s%s' % (s[:lhead], scont, s[-ltail:])
-    if just == 'r':
-        return s.rjust(width, fill)
-    elif just == 'c':
-        return s.center(width, fill)
-    else:
-        return s.ljust(width, fill)
-
 
 ###############################################################################
 #### Influential imports ######################################################
 ###############################################################################
-try:
-    import bencode
-    import bendcode
-except ImportError:
-    print_banner(["Please install the bencode/bendcode python modules. E.g.: sudo pip install bencode bendcode",], fill='!', file=sys.stderr)
-    raise
-try:
-    import emoji
-except ImportError:
+import btcodec
+from utorrent_common import FsCache, Reporter, emoji, print_hr, print_banner
+from utorrent_common import CACHE_PATH, load_columns, snapshot_path, FilterRules, IS_TORRENT, SINGLE_LABEL, COMPLETE
+from utorrent_common import path_exists, name_matches, label_matches
+from moveutils import MoveExecutor, MoveJournal
+from btverify import load_info, verify_torrents
+if emoji is None:
     print_hr("Consider installing the emoji python module for nicer output. E.g.: sudo pip install emoji", fill='!', file=sys.stderr)
 
 
+reporter = Reporter()
+POOL_MIN_TORRENTS = 32  # below this, torrents are hashed inline
+POOL_CHUNK_TORRENTS = 8  # torrents per pool task
+
+
 ###############################################################################
 #### Functionality helpers ####################################################
 ###############################################################################
-def check_torrent(torrent, metadata, args):
-    ''' Checks the torrent and its metadata to determine whether it
-        should be moved. For torrents that should be moved, a tuple
-        is returned. Otherwise a message is printed and None is returned.
+def torrent_hash(torrent_f):
+    ''' Returns the info-hash of torrent_f, or None for bad torrents.
+        The hash is taken directly over the raw info dictionary.
     '''
-    use_emojis = True if 'emoji' in sys.modules else False
-    if use_emojis:
-        emj = lambda s: emoji.emojize(s, use_aliases=True).encode('utf-8')
-
-    try: width = int(subprocess.check_output(['stty', 'size']).split()[1])
-    except: width = 80
-
-    def _torrent_hash(torrent):
-        torrent_f = os.path.join(args.ut_path, torrent)
-        print(torrent_f)
-        with open(torrent_f, 'rb') as torrent_f_in:
-            d = torrent_f_in.read()
-            try: # try default bencode module - faster
-                metainfo = bencode.bdecode(d)
-            except bencode.BTL.BTFailure:
-                pass
-            try: # fallback to bendcode - more robust
-                metainfo = bendcode.decode(d)
-            except:
-                return None
-            return hashlib.sha1(bencode.bencode(metainfo['info'])).hexdigest()  
-
-    def _make_message(torrent, action, reason):
-        values = {
-            'torrent': fit_string(torrent, width-20-5-6, 'l'),
-            'action': fit_string(action, 5, 'l'),
-            'reason': fit_string(reason, 20, 'c'),
-        }
-        if use_emojis:
-            if action == 'skip':
-                values['action'] = fit_string(emj(':no_entry:'), 4, 'l')
-            elif action == 'ok':
-                values['action'] = fit_string(emj(':checkered_flag:'), 5, 'l')
-            elif action == 'move':
-                values['action'] = fit_string(emj(':arrow_right:'), 4, 'l')
-            elif action == 'xfs':
-                values['action'] = fit_string(emj(':warning:'), 4, 'l')
-            elif action == 'wtf':
-                values['action'] = fit_string(emj(':interrobang:'), 4, 'l')
-            else:
-                values['action'] = fit_string(emj(':question:'), 4, 'l')
-        return '{action} | {torrent} | {reason}'.format(**values)             
-
-    if not torrent.endswith('.torrent'): # unresolved magnet links
-        print(_make_message(torrent, 'skip', 'not a torrent'))
-        return None
-    if metadata['completed_on'] == 0 and not args.incomplete:
-        print(_make_message(torrent, 'skip', 'incomplete'))
-        return None
-    if not os.path.exists(metadata['path']) and not args.incomplete:
-        print(_make_message(torrent, 'skip', 'invalid path'))
-        return None
-    if len(metadata['labels']) > 1:
-        print(_make_message(torrent, 'wtf', 'multiple labels'))
+    try:
+        with btcodec.mapped(torrent_f) as buf:
+            return btcodec.info_hash(buf)
+    except (OSError, btcodec.DecodeError, KeyError):
         return None
-    if not args.all:
-        if args.tag_re is not None:
-            m = re.match(args.tag_re, metadata['label'], flags=re.I|re.U)
-            if m is None:
-                print(_make_message(torrent, 'skip', 'not matching tag RE'))
-                return None
-        elif args.name_re is not None:
-            m = re.match(args.name_re, metadata['caption'], flags=re.I|re.U)
-            if m is None:
-                print(_make_message(torrent, 'skip', 'not matching name RE'))
-                return None
+
+def torrent_hashes(torrent_fs, cache_f=None, jobs=None):
+    ''' Computes the info-hashes of the specified torrent files.
+        Files are hashed in parallel over a process pool. Results are
+        kept in cache_f, keyed on the path, size and mtime of each file,
+        so unchanged files are not hashed again on later runs.
+        Returns a dict mapping each file to its hash, or None.
+    '''
+    cache = {}
+    if cache_f is not None:
+        try:
+            with open(cache_f) as cache_in:
+                cache = json.load(cache_in)
+        except (OSError, ValueError):
+            pass
+
+    thashes = {}
+    pending = []
+    for torrent_f in torrent_fs:
+        try:
+            st = os.stat(torrent_f)
+        except OSError:
+            thashes[torrent_f] = None
+            continue
+        stamp = [st.st_size, st.st_mtime_ns]
+        cached = cache.get(os.path.abspath(torrent_f))
+        if cached is not None and cached[:2] == stamp:
+            thashes[torrent_f] = cached[2]
         else:
-            print(_make_message(torrent, 'wtf', 'weird match config'))
-            return None
+            pending.append((torrent_f, stamp))
+    if not pending:
+        return thashes
 
-    # This is just an integrity check for now.
-    # Eventually, it can be used to directly import torrents into qBittorrent.
-    # Torrents are saved as thash.torrent along with a thash.fastresume file.
-    thash = _torrent_hash(torrent)
+    pending_fs = [torrent_f for torrent_f, _ in pending]
+    if len(pending) < POOL_MIN_TORRENTS:
+        results = list(map(torrent_hash, pending_fs))
+    else:
+        with concurrent.futures.ProcessPoolExecutor(jobs) as pool:
+            results = list(pool.map(torrent_hash, pending_fs, chunksize=POOL_CHUNK_TORRENTS))
+    for (torrent_f, stamp), thash in zip(pending, results):
+        thashes[torrent_f] = thash
+        if thash is not None:
+            cache[os.path.abspath(torrent_f)] = stamp + [thash]
+
+    if cache_f is not None:
+        try:
+            os.makedirs(os.path.dirname(cache_f), exist_ok=True)
+            with open('%s.tmp' % (cache_f), 'w') as cache_out:
+                json.dump(cache, cache_out)
+            os.replace('%s.tmp' % (cache_f), cache_f)
+        except OSError as e:
+            print_hr('Could not update hash cache: %s' % (e), fill='!', file=sys.stderr)
+    return thashes
+
+def migrate_rules(args, fscache):
+    ''' Returns the rules for selecting the torrents to migrate,
+        according to the configured filters.
+    '''
+    rules = FilterRules([(IS_TORRENT, 'skip', 'not a torrent')])
+    if not args.incomplete:
+        rules.add(COMPLETE, 'skip', 'incomplete')
+        rules.add(path_exists(fscache), 'skip', 'invalid path')
+    rules.add(SINGLE_LABEL, 'wtf', 'multiple labels')
+    if args.tag_re is not None:
+        rules.add(label_matches(args.tag_re), 'skip', 'not matching tag RE')
+    elif args.name_re is not None:
+        rules.add(name_matches(args.name_re), 'skip', 'not matching name RE')
+    return rules
+
+def check_torrent(torrent, p, l, args, thash, fscache):
+    ''' Checks the torrent path p and label l to determine whether it
+        should be moved. Only torrents selected by migrate_rules() should
+        be checked. For torrents that should be moved, a tuple is
+        returned. Otherwise a message is printed and None is returned.
+    '''
+    # Torrents that can't be hashed can't be exported to BT_backup either.
     if thash is None:
-        print(_make_message(torrent, 'skip', 'bad torrent'))
+        reporter.report(torrent, 'skip', 'bad torrent')
         return None
 
-    # Get path, label, tag.
-    p = metadata['path']
-    l = metadata['label']
-
     # Make from/to directories. A number of dashes from the label will be
     # converted to subdirectories, according to args.ndash.
     d_from = os.path.dirname(p)
@@ -179,24 +157,113 @@ def check_torrent(torrent, metadata, args):
     p_to = os.path.join(d_to, os.path.basename(p))
     
     # Check directories.
-    on_same_fs = lambda p1, p2: os.stat(p1).st_dev == os.stat(p2).st_dev
     if d_from == d_to:
-        print(_make_message(torrent, 'wtf', 'no action required'))
+        reporter.report(torrent, 'wtf', 'no action required')
         return None
     elif not args.xfs:
         # Check for same fs.
-        if os.path.exists(d_to) and not on_same_fs(os.path.dirname(d_from), os.path.dirname(d_to)):
-            print(_make_message(torrent, 'xfs', 'xfs disabled'))
+        if fscache.exists(d_to) and not fscache.same_fs(os.path.dirname(d_from), os.path.dirname(d_to)):
+            reporter.report(torrent, 'xfs', 'xfs disabled')
             return None
-        elif not on_same_fs(os.path.dirname(d_from), os.path.dirname(args.qt_dlpath)):
-            print(_make_message(torrent, 'xfs', 'xfs disabled'))
+        elif not fscache.same_fs(os.path.dirname(d_from), os.path.dirname(args.qt_dlpath)):
+            reporter.report(torrent, 'xfs', 'xfs disabled')
             return None
 
     # # everything ok - return an action tuple
-    print(_make_message(torrent, 'move', 'moving'))
+    reporter.report(torrent, 'move', 'moving')
     return (p, p_to, d_to)    
 
 
+###############################################################################
+#### qBittorrent export #######################################################
+###############################################################################
+def torrent_category(label, ndash):
+    ''' Converts a uTorrent label to a qBittorrent category. Dashes are
+        converted to subcategories, the same way they are converted to
+        subdirectories of the download path.
+    '''
+    return '/'.join(label.split('-', ndash)) if label else ''
+
+def have_to_pieces(have, npieces):
+    ''' Converts uTorrent's have bitfield (one bit per piece, most
+        significant bit first) to a libtorrent pieces field (one byte per
+        piece, 1 for downloaded pieces).
+    '''
+    have = btcodec.to_bytes(have).ljust((npieces + 7) // 8, b'\x00')
+    return bytes((have[i >> 3] >> (7 - (i & 7))) & 1 for i in range(npieces))
+
+def make_fastresume(metadata, info, thash, save_path, category, content_name, complete=False):
+    ''' Creates the fastresume dictionary for a torrent, from its uTorrent
+        metadata. content_name is the name of the downloaded file or
+        directory in save_path. When it differs from the torrent name,
+        the files of the torrent are mapped to it. With complete, all the
+        pieces are marked as downloaded, regardless of the metadata.
+    '''
+    npieces = len(btcodec.to_bytes(info['pieces'])) // 20
+    if complete:
+        pieces = b'\x01' * npieces
+    elif 'have' in metadata:
+        pieces = have_to_pieces(metadata['have'], npieces)
+    else:
+        pieces = (b'\x01' if metadata.get('completed_on', 0) else b'\x00') * npieces
+    started = metadata.get('started', 0)
+    fastresume = {
+        'file-format': 'libtorrent resume file',
+        'file-version': 1,
+        'info-hash': btcodec.to_str(bytes.fromhex(thash)),
+        'save_path': save_path,
+        'pieces': btcodec.to_str(pieces),
+        'paused': 0 if started else 1,
+        'auto_managed': 0 if started == 1 else 1,  # 1 is force start
+        'added_time': metadata.get('added_on', 0),
+        'completed_time': metadata.get('completed_on', 0),
+        'total_uploaded': metadata.get('uploaded', 0),
+        'total_downloaded': metadata.get('downloaded', 0),
+        'seeding_time': metadata.get('seedtime', 0),
+        'active_time': metadata.get('runtime', 0),
+        'qBt-savePath': save_path,
+        'qBt-category': category,
+        'qBt-tags': [],
+        'qBt-name': metadata.get('caption', ''),
+    }
+    if content_name != info['name']:
+        if 'files' in info:
+            fastresume['mapped_files'] = [os.path.join(content_name, *f['path']) for f in info['files']]
+        else:
+            fastresume['mapped_files'] = [content_name]
+    return fastresume
+
+def prepare_export(torrent_f, metadata, content_path, category, complete=False):
+    ''' Prepares the qBittorrent export of torrent_f, with its data at
+        content_path. Returns the info-hash of the torrent and its
+        fastresume dictionary.
+    '''
+    with btcodec.mapped(torrent_f) as buf:
+        thash = btcodec.info_hash(buf)
+        info = btcodec.decode(buf, btcodec.index(buf)[0]['info'][1])[0]
+    fastresume = make_fastresume(metadata, info, thash,
+        os.path.dirname(os.path.abspath(content_path)), category, os.path.basename(content_path), complete)
+    return thash, fastresume
+
+def export_fastresume(torrent_f, thash, fastresume, bt_backup, dryrun=False):
+    ''' Exports torrent_f to the qBittorrent BT_backup directory as
+        <hash>.torrent, along with its prepared <hash>.fastresume file.
+        Files are written under a temporary name and renamed in place.
+    '''
+    print("cp '%s' '%s'" % (torrent_f, os.path.join(bt_backup, '%s.torrent' % (thash))))
+    print("write '%s'" % (os.path.join(bt_backup, '%s.fastresume' % (thash))))
+    if dryrun:
+        return
+    with open(torrent_f, 'rb') as torrent_in:
+        raw = torrent_in.read()
+    os.makedirs(bt_backup, exist_ok=True)
+    for ext, data in (('torrent', raw), ('fastresume', btcodec.encode(fastresume))):
+        out_f = os.path.join(bt_backup, '%s.%s' % (thash, ext))
+        with open('%s.tmp' % (out_f), 'wb') as out:
+            out.write(data)
+        os.replace('%s.tmp' % (out_f), out_f)
+
+
 ###############################################################################
 #### Real action ##############################################################
 ###############################################################################
@@ -227,6 +294,32 @@ def main():
     parser.add_argument("-e", "--export-path", default=None,
             action="store", dest="export_path", help="where to export the torrent files (default: home dir)"
     )
+    parser.add_argument("--bt-backup", default=None,
+            action="store", dest="bt_backup", help="qBittorrent BT_backup directory to write .torrent and .fastresume files to, instead of importing them manually"
+    )
+    parser.add_argument("--hash-cache", default=os.path.join(CACHE_PATH, 'utorrent2qbittorent.hashes.json'),
+            action="store", dest="hash_cache", help="where to cache torrent info-hashes between runs"
+    )
+    parser.add_argument("--snapshot", default=None,
+            action="store", dest="snapshot", help="snapshot of resume.dat, reused while resume.dat is unchanged (default: in ~/.cache/cliutils)"
+    )
+    parser.add_argument("--no-snapshot",
+        action="store_true", dest="no_snapshot", default=False,
+        help="always read resume.dat"
+    )
+    parser.add_argument("-j", "--jobs", type=int, default=None,
+            action="store", dest="jobs", help="number of parallel jobs to use for hashing torrents and scanning directories"
+    )
+    parser.add_argument("--verify",
+        action="store_true", dest="verify", default=False,
+        help="verify the torrent data against their piece hashes and skip torrents with bad pieces"
+    )
+    parser.add_argument("--copy-jobs", type=int, default=4,
+            action="store", dest="copy_jobs", help="number of parallel copies when moving across filesystems (default: 4)"
+    )
+    parser.add_argument("--journal", default=None,
+            action="store", dest="journal", help="journal of completed moves, used to resume interrupted runs (default: resume.dat.journal)"
+    )
     match = parser.add_mutually_exclusive_group(required=True)
     match.add_argument('--name', action="store", dest="name_re", help="only process torrents with caption matching this re")
     match.add_argument('--tag', action="store", dest="tag_re", help="only process torrents with labels matching this re")
@@ -239,10 +332,21 @@ def main():
 
     ################################################
     # Read resume.dat.
+    # Torrent entries are only decoded when accessed.
     ################################################
     resume_dat_f = args.resume_dat
-    with open(resume_dat_f, 'rb') as resume_dat_in:
-        resume_dat = bencode.bdecode(resume_dat_in.read())
+    resume_dat = btcodec.load(resume_dat_f)
+
+    # Apply the moves completed by an interrupted run and resume the rest.
+    journal = MoveJournal(args.journal if args.journal else '%s.journal' % (resume_dat_f))
+    executor = MoveExecutor(journal, jobs=args.copy_jobs, dryrun=args.dryrun)
+    for torrent in journal.done:
+        if not args.dryrun and torrent in resume_dat:
+            del resume_dat[torrent]
+    pending = journal.pending
+    jobs = dict(pending)
+    for torrent, moves in pending.items():
+        executor.add(torrent, moves)
 
     ################################################
     # Set uTorrent config path and torrent export path.
@@ -251,6 +355,8 @@ def main():
         args.ut_path = os.path.dirname(os.path.abspath(resume_dat_f))
     if args.export_path is None:
         args.export_path = os.path.expanduser("~")
+    if args.bt_backup is not None:
+        args.bt_backup = os.path.abspath(args.bt_backup)
 
     ################################################
     # Print active configuration.
@@ -260,6 +366,7 @@ def main():
             'Move Across FS: %s' % (args.xfs),
             'uTorrent config path: %s' % (args.ut_path),
             'qBittorrent download path: %s' % (args.qt_dlpath),
+            'qBittorrent BT_backup path: %s' % (args.bt_backup),
     ]
     print_banner(cfg_banner)
     print('')
@@ -268,22 +375,72 @@ def main():
     # Check what has to be done.
     ################################################
     print_banner(['Analyzing actions'])
+    # Look up the torrent directories in one go, before any decisions.
+    snapshot_f = None if args.no_snapshot else (args.snapshot or snapshot_path(resume_dat_f))
+    columns = load_columns(resume_dat_f, resume_dat, snapshot_f)
+    fscache = FsCache(args.jobs)
+    fscache.prefetch([columns.path[i] for i in IS_TORRENT(columns)])
+    for torrent in pending:
+        reporter.report(torrent, 'move', 'resume move')
+    rows = [i for i, torrent in enumerate(columns.keys)
+        if torrent not in pending and torrent not in journal.done]
+    selected = migrate_rules(args, fscache).select(columns, reporter, rows)
+    thashes = torrent_hashes([os.path.join(args.ut_path, columns.keys[i]) for i in selected],
+        args.hash_cache, args.jobs)
     actions = {}
-    for torrent, metadata in resume_dat.iteritems():
-        action = check_torrent(torrent, metadata, args)
+    for i in selected:
+        torrent = columns.keys[i]
+        thash = thashes[os.path.join(args.ut_path, torrent)]
+        action = check_torrent(torrent, columns.path[i], columns.label[i] or '', args, thash, fscache)
         if action is not None:
             actions[torrent] = action
+    reporter.flush()
     print('')
 
+    ################################################
+    # Verify torrent data.
+    ################################################
+    verified = set()
+    if args.verify and actions:
+        print_banner(['Verifying torrent data'])
+        torrents = [(torrent, load_info(os.path.join(args.ut_path, torrent)), actions[torrent][0])
+            for torrent in actions]
+        for torrent, npieces, bad in verify_torrents(torrents, args.jobs):
+            if bad:
+                complete = 100.0 * (npieces - len(bad)) / npieces
+                reporter.report(torrent, 'skip', 'bad data (%.1f%%)' % (complete))
+                del actions[torrent]
+            else:
+                reporter.report(torrent, 'ok', 'verified')
+                verified.add(torrent)
+        reporter.flush()
+        print('')
+
     ################################################
     # Execute actions.
     ################################################
     print_banner(['Hammer time!%s' % (' (dry run)' if args.dryrun else '')])
+    finished = False
+    exports = {}
     try:
-        if not actions:
+        if not actions and not pending:
             print('Nothing to do!')
         for torrent in actions:
             path_orig, path_dest, dir_dest = actions[torrent]
+            torrent_from = os.path.join(args.ut_path, torrent)
+            torrent_to = os.path.join(args.export_path, torrent)
+
+            # Prepare the export before moving, so that a torrent that
+            # can't be exported is left alone.
+            if args.bt_backup is not None:
+                metadata = resume_dat[torrent]
+                try:
+                    exports[torrent] = prepare_export(torrent_from, metadata, path_dest,
+                        torrent_category(metadata.get('label'), args.ndash), complete=torrent in verified)
+                except (OSError, btcodec.DecodeError, KeyError, ValueError) as e:
+                    print("Not moving '%s', failed to export it to BT_backup: %s" % (torrent, e), file=sys.stderr)
+                    print_hr(fill='-')
+                    continue
 
             # Remove any empty path components of path_dest.
             try:
@@ -298,17 +455,39 @@ def main():
             except OSError:
                 pass
 
-            # Do the moving.
-            torrent_from = os.path.join(args.ut_path, torrent)
-            if not args.dryrun:
-                shutil.move(path_orig, dir_dest)
-                shutil.move(torrent_from, args.export_path)
-            del resume_dat[torrent]
+            # Queue the moving. Paths are journaled absolute, so that an
+            # interrupted run can be resumed from any directory.
+            jobs[torrent] = [(os.path.abspath(path_orig), os.path.abspath(path_dest)),
+                (os.path.abspath(torrent_from), os.path.abspath(torrent_to))]
+            executor.add(torrent, jobs[torrent])
             print("mv '%s' '%s'" % (path_orig, dir_dest))
             print("mv '%s' '%s'" % (torrent_from, args.export_path))
             print_hr(fill='-')
+
+        # Do the moving.
+        for torrent in executor.run():
+            if args.bt_backup is not None:
+                # Moved torrents are exported from their new location.
+                (path_orig, path_dest), (torrent_from, torrent_to) = jobs[torrent]
+                torrent_f = torrent_from if args.dryrun else torrent_to
+                try:
+                    if torrent not in exports:
+                        # Resumed moves are only prepared once moved.
+                        metadata = resume_dat[torrent]
+                        exports[torrent] = prepare_export(torrent_f, metadata, path_dest,
+                            torrent_category(metadata.get('label'), args.ndash))
+                    export_fastresume(torrent_f, *exports[torrent], args.bt_backup, dryrun=args.dryrun)
+                except (OSError, btcodec.DecodeError, KeyError, ValueError) as e:
+                    # Kept in resume.dat, so it is not dropped from both clients.
+                    print("Failed to export '%s' to BT_backup, keeping it in resume.dat: %s" % (torrent, e), file=sys.stderr)
+                    continue
+            # Nothing is written on dry runs, and deleting would index all
+            # of resume.dat, even when the snapshot was used.
+            if not args.dryrun:
+                del resume_dat[torrent]
+        finished = True
     finally:
-        if actions:
+        if actions or journal.done or pending:
             ################################################
             # Make a backup for resume.dat and write updated file.
             ################################################
@@ -318,8 +497,12 @@ def main():
                 shutil.copyfile(resume_dat_f, resume_dat_bak_f)
             print("Writing new resume.dat to %s." % (resume_dat_f))
             if not args.dryrun:
-                with open(resume_dat_f,'wb+') as resume_dat_out:
-                    resume_dat_out.write(bencode.bencode(resume_dat))
+                # Deleted entries are skipped, everything else is copied
+                # verbatim. The new file is atomically renamed in place.
+                btcodec.save(resume_dat, resume_dat_f)
+                # The journal is kept for the moves not applied yet, if
+                # interrupted, and for the failed ones.
+                journal.close(remove=finished and not journal.pending)
             print_hr(fill='-')
     print('Finished!')
 
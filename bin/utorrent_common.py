@@ -0,0 +1,489 @@
+# -*- coding: utf-8 -*-
+'''
+Helpers shared by the uTorrent scripts (utorrent_tidy.py and
+utorrent2qbittorent.py).
+
+Original on: https://github.com/m000/cliutils
+'''
+
+import os, sys, re, shutil, signal, hashlib
+import sqlite3
+import concurrent.futures
+from collections.abc import Mapping
+
+import btcodec
+
+CACHE_PATH = os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'), 'cliutils')
+
+try:
+    import emoji
+except ImportError:
+    emoji = None
+
+
+###############################################################################
+#### Format helpers ###########################################################
+###############################################################################
+_terminal_width = None
+
+def _update_terminal_width(*args):
+    global _terminal_width
+    _terminal_width = shutil.get_terminal_size((80, 24)).columns
+
+def terminal_width():
+    ''' Returns the terminal width. The width is looked up once and is
+        then kept up to date by a SIGWINCH handler.
+    '''
+    if _terminal_width is None:
+        _update_terminal_width()
+        try:
+            signal.signal(signal.SIGWINCH, _update_terminal_width)
+        except (AttributeError, ValueError):
+            # No SIGWINCH on this platform, or not in the main thread.
+            pass
+    return _terminal_width
+
+def make_hr(text=None, width=None, fill='#'):
+    ''' Creates an ascii horizontal ruler.'''
+    if width is None:
+        width = terminal_width()
+    return ''.ljust(width, fill) if not text else ('%s %s ' % (3*fill, text)).ljust(width, fill)
+
+def print_hr(text=None, width=None, fill='#', file=sys.stdout):
+    ''' Print an ascii horizontal ruler.'''
+    print(make_hr(text, width, fill), file=file)
+
+def print_banner(lines=[], width=None, fill='#', file=sys.stdout):
+    ''' Prints the specified lines in a banner-like format.'''
+    ljust_len = max([len(s) for s in lines])+1
+    print_hr(width=width, fill=fill, file=file)
+    for l in lines:
+        print_hr(l.ljust(ljust_len), width=width, fill=fill, file=file)
+    print_hr(width=width, fill=fill, file=file)
+
+def fit_string(s, width, just='l', fill=' '):
+    ''' Fits string s to the specified width.'''
+    if len(s) > width:
+        scont = '...'
+        ltail = (width-len(scont))//2
+        lhead = width-len(scont)-ltail
+        s = '%s%s%s' % (s[:lhead], scont, s[-ltail:])
+    if just == 'r':
+        return s.rjust(width, fill)
+    elif just == 'c':
+        return s.center(width, fill)
+    else:
+        return s.ljust(width, fill)
+
+
+class Reporter(object):
+    ''' Buffered report of the action decided for each torrent.
+        Report lines are written out in batches of bufsize lines, or when
+        flush() is called. Action markers are rendered only once.
+    '''
+    MARKERS = {
+        'skip': (':no_entry:', 4),
+        'ok': (':checkered_flag:', 5),
+        'move': (':arrow_right:', 4),
+        'xfs': (':warning:', 4),
+        'wtf': (':interrobang:', 4),
+        None: (':question:', 4),
+    }
+
+    def __init__(self, file=sys.stdout, bufsize=256):
+        self.file = file
+        self.bufsize = bufsize
+        self.lines = []
+        self.markers = None
+        if emoji is not None:
+            try:
+                self.markers = {action: fit_string(emoji.emojize(e, language='alias'), w, 'l')
+                    for action, (e, w) in self.MARKERS.items()}
+            except TypeError:
+                # emoji < 2.0, plain markers are used
+                pass
+
+    def format(self, torrent, action, reason):
+        ''' Formats a report line for the action taken on torrent.'''
+        if self.markers is not None:
+            marker = self.markers.get(action, self.markers[None])
+        else:
+            marker = fit_string(action, 5, 'l')
+        return '%s | %s | %s' % (
+            marker,
+            fit_string(torrent, terminal_width()-20-5-6, 'l'),
+            fit_string(reason, 20, 'c'),
+        )
+
+    def report(self, torrent, action, reason):
+        ''' Adds a report line for the action taken on torrent.'''
+        self.lines.append(self.format(torrent, action, reason))
+        if len(self.lines) >= self.bufsize:
+            self.flush()
+
+    def flush(self):
+        ''' Writes out any buffered report lines.'''
+        if self.lines:
+            self.lines.append('')
+            self.file.write('\n'.join(self.lines))
+            self.lines = []
+        self.file.flush()
+
+
+###############################################################################
+#### Filesystem lookups #######################################################
+###############################################################################
+class FsCache(object):
+    ''' Memoized filesystem lookups for planning moves.
+        Existence of a path is answered from a single listing of its
+        parent directory, and the device id of each directory is looked
+        up only once. This keeps the number of filesystem round trips
+        proportional to the number of distinct directories rather than
+        the number of torrents.
+    '''
+    def __init__(self, jobs=None):
+        self.jobs = jobs
+        self._listings = {}
+        self._stats = {}
+
+    def _list(self, d):
+        try:
+            with os.scandir(d or os.curdir) as it:
+                return frozenset(e.name for e in it)
+        except OSError:
+            return None
+
+    def _stat(self, p):
+        try:
+            return os.stat(p)
+        except OSError as e:
+            return e
+
+    def prefetch(self, paths):
+        ''' Looks up the parent directories of paths, and their parents in
+            turn, fanning out the lookups over a thread pool. Empty paths
+            are skipped.
+        '''
+        parents = {os.path.dirname(os.path.normpath(p)) for p in paths if p}
+        parents.difference_update(self._listings)
+        grandparents = {os.path.dirname(d) for d in parents}
+        grandparents.difference_update(self._stats)
+        with concurrent.futures.ThreadPoolExecutor(self.jobs) as pool:
+            self._listings.update(zip(parents, pool.map(self._list, parents)))
+            self._stats.update(zip(grandparents, pool.map(self._stat, grandparents)))
+
+    def exists(self, p):
+        ''' Memoized os.path.exists().'''
+        d, name = os.path.split(os.path.normpath(p))
+        if not name:
+            return os.path.exists(p)
+        if d not in self._listings:
+            self._listings[d] = self._list(d)
+        listing = self._listings[d]
+        if listing is None:
+            # Missing or unlistable parent.
+            return os.path.exists(p)
+        return name in listing
+
+    def stat(self, p):
+        ''' Memoized os.stat(). Failures are memoized as well.'''
+        if p not in self._stats:
+            self._stats[p] = self._stat(p)
+        st = self._stats[p]
+        if isinstance(st, OSError):
+            raise st
+        return st
+
+    def same_fs(self, p1, p2):
+        ''' Checks whether p1 and p2 reside on the same filesystem.'''
+        return self.stat(p1).st_dev == self.stat(p2).st_dev
+
+
+class PathTrie(object):
+    ''' Trie of path components. Each node counts the paths inserted at
+        or below it, and the paths ending at it. Nodes are [total, ends,
+        children] lists.
+    '''
+    def __init__(self):
+        self.root = [0, 0, {}]
+
+    @staticmethod
+    def split(path):
+        ''' Splits path into components, ignoring any trailing separator.
+            Absolute paths start with an empty component.
+        '''
+        return path.rstrip(os.sep).split(os.sep) if path.strip(os.sep) else [''] * bool(path)
+
+    @staticmethod
+    def join(components):
+        ''' Inverse of split().'''
+        return os.sep.join(components) if tuple(components) != ('',) else os.sep
+
+    def insert(self, path, n=1):
+        ''' Adds n occurrences of path to the trie.'''
+        node = self.root
+        node[0] += n
+        for c in self.split(path):
+            node = node[2].setdefault(c, [0, 0, {}])
+            node[0] += n
+        node[1] += n
+
+    def count(self, path):
+        ''' Returns the number of paths inserted at or below path.'''
+        node = self.root
+        for c in self.split(path):
+            node = node[2].get(c)
+            if node is None:
+                return 0
+        return node[0]
+
+    def __len__(self):
+        return self.root[0]
+
+    def ends(self):
+        ''' Returns the (path, count) tuples of the inserted paths, most
+            frequent first. Ties are ordered by path, so the result is
+            deterministic.
+        '''
+        ends = []
+        stack = [((), self.root)]
+        while stack:
+            components, node = stack.pop()
+            if node[1]:
+                ends.append((self.join(components), node[1]))
+            stack.extend((components + (c,), child) for c, child in node[2].items())
+        return sorted(ends, key=lambda e: (-e[1], e[0]))
+
+
+###############################################################################
+#### Torrent columns ##########################################################
+###############################################################################
+class TorrentColumns(object):
+    ''' Columnar view of the entries of resume.dat.
+        Each field is kept in a list parallel to keys. Fields missing from
+        an entry are None, and labels is a tuple of all the entry labels.
+        info_hash is the hex info-hash kept by uTorrent in the info field.
+        Non-torrent entries (e.g. .fileguard) are kept with all fields None.
+    '''
+    FIELDS = ('caption', 'label', 'labels', 'path', 'completed_on', 'info_hash')
+
+    def __init__(self, keys, **columns):
+        self.keys = list(keys)
+        self._rows = None
+        for field in self.FIELDS:
+            setattr(self, field, list(columns.get(field, [None]*len(self.keys))))
+
+    @classmethod
+    def from_resume_dat(cls, resume_dat):
+        ''' Builds the columns from a (lazily decoded) resume.dat dict.
+            Only the fields in FIELDS are decoded.
+        '''
+        keys = list(resume_dat)
+        columns = {field: [] for field in cls.FIELDS}
+        for key in keys:
+            metadata = resume_dat[key]
+            if not isinstance(metadata, Mapping):
+                metadata = {}
+            for field in cls.FIELDS[:-1]:
+                columns[field].append(metadata.get(field))
+            info = metadata.get('info')
+            columns['info_hash'].append(btcodec.to_bytes(info).hex() if isinstance(info, str) else None)
+        columns['labels'] = [tuple(l) if l is not None else () for l in columns['labels']]
+        return cls(keys, **columns)
+
+    def row(self, key):
+        ''' Returns the row of key, or None.'''
+        if self._rows is None:
+            self._rows = {k: i for i, k in enumerate(self.keys)}
+        return self._rows.get(key)
+
+    def __len__(self):
+        return len(self.keys)
+
+
+###############################################################################
+#### Snapshots ################################################################
+###############################################################################
+SNAPSHOT_VERSION = 1
+
+def snapshot_path(resume_dat_f):
+    ''' Returns the default snapshot file for resume_dat_f.'''
+    h = hashlib.sha1(os.path.abspath(resume_dat_f).encode('utf-8', 'surrogateescape')).hexdigest()
+    return os.path.join(CACHE_PATH, 'resume.%s.sqlite' % (h[:16]))
+
+def _stamp(resume_dat_f):
+    st = os.stat(resume_dat_f)
+    return [SNAPSHOT_VERSION, st.st_size, st.st_mtime_ns, st.st_ino]
+
+def _blob(s):
+    return None if s is None else btcodec.to_bytes(s)
+
+def _unblob(b):
+    return None if b is None else btcodec.to_str(b)
+
+def read_snapshot(snapshot_f, resume_dat_f):
+    ''' Reads the columns of resume_dat_f from an SQLite snapshot.
+        Returns None if there is no snapshot, or if resume_dat_f has
+        changed (in size, mtime or inode) since the snapshot was taken.
+    '''
+    if not os.path.exists(snapshot_f):
+        return None
+    try:
+        db = sqlite3.connect(snapshot_f)
+        try:
+            stamp = db.execute('SELECT version, size, mtime_ns, ino FROM source').fetchone()
+            if stamp is None or list(stamp) != _stamp(resume_dat_f):
+                return None
+            rows = db.execute('SELECT key, caption, label, labels, path, completed_on, info_hash'
+                ' FROM torrents ORDER BY row').fetchall()
+        finally:
+            db.close()
+    except (OSError, sqlite3.Error):
+        return None
+    columns = list(zip(*rows)) if rows else [()] * 7
+    return TorrentColumns(map(_unblob, columns[0]),
+        caption=map(_unblob, columns[1]),
+        label=map(_unblob, columns[2]),
+        labels=[tuple(btcodec.decode(l)[0]) if l is not None else () for l in columns[3]],
+        path=map(_unblob, columns[4]),
+        completed_on=columns[5],
+        info_hash=columns[6],
+    )
+
+def write_snapshot(snapshot_f, resume_dat_f, columns):
+    ''' Writes the columns of resume_dat_f to an SQLite snapshot.
+        The snapshot is built in a temporary file and renamed in place.
+    '''
+    stamp = _stamp(resume_dat_f)
+    os.makedirs(os.path.dirname(os.path.abspath(snapshot_f)), exist_ok=True)
+    tmp_f = '%s.tmp' % (snapshot_f)
+    if os.path.exists(tmp_f):
+        os.remove(tmp_f)
+    db = sqlite3.connect(tmp_f)
+    try:
+        with db:
+            db.execute('CREATE TABLE source (version INTEGER, size INTEGER, mtime_ns INTEGER, ino INTEGER)')
+            db.execute('CREATE TABLE torrents (row INTEGER PRIMARY KEY, key BLOB, caption BLOB,'
+                ' label BLOB, labels BLOB, path BLOB, completed_on INTEGER, info_hash TEXT)')
+            db.execute('INSERT INTO source VALUES (?, ?, ?, ?)', stamp)
+            db.executemany('INSERT INTO torrents VALUES (?, ?, ?, ?, ?, ?, ?, ?)', zip(
+                range(len(columns)),
+                map(_blob, columns.keys),
+                map(_blob, columns.caption),
+                map(_blob, columns.label),
+                (btcodec.encode(list(l)) for l in columns.labels),
+                map(_blob, columns.path),
+                columns.completed_on,
+                columns.info_hash,
+            ))
+    finally:
+        db.close()
+    os.replace(tmp_f, snapshot_f)
+
+def load_columns(resume_dat_f, resume_dat, snapshot_f=None):
+    ''' Returns the columns of resume_dat_f, read from snapshot_f if it is
+        up to date. Otherwise, the columns are built from resume_dat and the
+        snapshot is updated. No snapshot is used if snapshot_f is None.
+    '''
+    if snapshot_f is None:
+        return TorrentColumns.from_resume_dat(resume_dat)
+    columns = read_snapshot(snapshot_f, resume_dat_f)
+    if columns is None:
+        columns = TorrentColumns.from_resume_dat(resume_dat)
+        try:
+            write_snapshot(snapshot_f, resume_dat_f, columns)
+        except (OSError, sqlite3.Error) as e:
+            print_hr('Could not write snapshot: %s' % (e), fill='!', file=sys.stderr)
+    return columns
+
+
+###############################################################################
+#### Torrent filters ##########################################################
+###############################################################################
+class Filter(object):
+    ''' Predicate over TorrentColumns, compiled once and evaluated in a
+        single pass over the rows it is given.
+        Calling a filter returns the rows that pass it, in order. Filters
+        are combined with &, | and ~. The right-hand side of & is only
+        evaluated for the rows that passed the left-hand side, and the
+        right-hand side of | only for the rows that failed it.
+    '''
+    def __init__(self, func):
+        self.func = func
+
+    @classmethod
+    def column(cls, field, pred):
+        ''' Creates a filter applying pred to the values of a column.'''
+        def func(columns, rows):
+            values = getattr(columns, field)
+            return [i for i in rows if pred(values[i])]
+        return cls(func)
+
+    def __call__(self, columns, rows=None):
+        return self.func(columns, range(len(columns)) if rows is None else rows)
+
+    def __and__(self, other):
+        return Filter(lambda columns, rows: other(columns, self(columns, rows)))
+
+    def __or__(self, other):
+        def func(columns, rows):
+            passed = set(self(columns, rows))
+            passed.update(other(columns, [i for i in rows if i not in passed]))
+            return [i for i in rows if i in passed]
+        return Filter(func)
+
+    def __invert__(self):
+        def func(columns, rows):
+            passed = set(self(columns, rows))
+            return [i for i in rows if i not in passed]
+        return Filter(func)
+
+
+ALL = Filter(lambda columns, rows: list(rows))
+IS_TORRENT = Filter.column('keys', lambda k: k.endswith('.torrent')) # not unresolved magnet links
+HAS_LABEL = Filter.column('label', lambda l: l is not None)
+SINGLE_LABEL = Filter.column('labels', lambda ls: len(ls) <= 1)
+COMPLETE = Filter.column('completed_on', lambda c: bool(c))
+
+def path_exists(fscache):
+    ''' Filter for torrents whose path exists, looked up through fscache.'''
+    return Filter.column('path', lambda p: p is not None and fscache.exists(p))
+
+def name_matches(pattern):
+    ''' Filter for torrents with caption matching the pattern.'''
+    match = re.compile(pattern, flags=re.I|re.U).match
+    return Filter.column('caption', lambda c: c is not None and match(c) is not None)
+
+def label_matches(pattern):
+    ''' Filter for torrents with label matching the pattern.'''
+    match = re.compile(pattern, flags=re.I|re.U).match
+    return Filter.column('label', lambda l: l is not None and match(l) is not None)
+
+
+class FilterRules(object):
+    ''' Ordered (filter, action, reason) rules for selecting torrents.
+        Each rule is evaluated only on the rows that passed the previous
+        rules. Rows failing a rule are reported with the rule action and
+        reason, in their original order.
+    '''
+    def __init__(self, rules=()):
+        self.rules = list(rules)
+
+    def add(self, filter, action, reason):
+        self.rules.append((filter, action, reason))
+        return self
+
+    def select(self, columns, reporter=None, rows=None):
+        ''' Returns the rows passing all the rules.'''
+        rows = range(len(columns)) if rows is None else rows
+        rejected = []
+        for filter, action, reason in self.rules:
+            passed = filter(columns, rows)
+            if len(passed) < len(rows):
+                keep = set(passed)
+                rejected.extend((i, action, reason) for i in rows if i not in keep)
+            rows = passed
+        if reporter is not None:
+            for i, action, reason in sorted(rejected):
+                reporter.report(columns.keys[i], action, reason)
+        return list(rows)
@@ -1,4 +1,4 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 #
 # uTorrent cleanup script.
@@ -10,150 +10,103 @@
 # Original on: https://github.com/m000/cliutils
 #
 
-from __future__ import print_function
-import os, sys, subprocess, shutil
+import os, sys
 import re, argparse
-import random
 from pprint import pprint
 
 
-###############################################################################
-#### Format helpers ###########################################################
-###############################################################################
-def make_hr(text=None, width=None, fill='#'):
-    ''' Creates an ascii horizontal ruler.'''
-    if width is None:
-        try: width = int(subprocess.check_output(['stty', 'size']).split()[1])
-        except: width = 80
-    return ''.ljust(width, fill) if not text else ('%s %s ' % (3*fill, text)).ljust(width, fill)
-
-def print_hr(text=None, width=None, fill='#', file=sys.stdout):
-    ''' Print an ascii horizontal ruler.'''
-    print(make_hr(text, width, fill), file=file)
-
-def print_banner(lines=[], width=None, fill='#', file=sys.stdout):
-    ''' Prints the specified lines in a banner-like format.'''
-    ljust_len = max([len(s) for s in lines])+1
-    print_hr(width=width, fill=fill, file=file)
-    for l in lines:
-        print_hr(l.ljust(ljust_len), width=width, fill=fill, file=file)
-    print_hr(width=width, fill=fill, file=file)
-
-def fit_string(s, width, just='l', fill=' '):
-    ''' Fits string s to the specified width.'''
-    if len(s) > width:
-        scont = '...'
-        ltail = (width-len(scont))/2
-        lhead = width-len(scont)-ltail
-        s = '%s%s%s' % (s[:lhead], scont, s[-ltail:])
-    if just == 'r':
-        return s.rjust(width, fill)
-    elif just == 'c':
-        return s.center(width, fill)
-    else:
-        return s.ljust(width, fill)
-
-
 ###############################################################################
 #### Influential imports ######################################################
 ###############################################################################
-try:
-    import bencode
-except ImportError:
-    print_banner(["Please install the bencode python module. E.g.: sudo pip install bencode",], fill='!', file=sys.stderr)
-    raise
-try:
-    import emoji
-except ImportError:
+import btcodec
+from utorrent_common import FsCache, PathTrie, Reporter, emoji, print_hr, print_banner
+from utorrent_common import load_columns, snapshot_path, FilterRules, IS_TORRENT, HAS_LABEL, SINGLE_LABEL, COMPLETE, path_exists
+from moveutils import MoveExecutor, MoveJournal
+if emoji is None:
     print_hr("Consider installing the emoji python module for nicer output. E.g.: sudo pip install emoji", fill='!', file=sys.stderr)
 
 
+reporter = Reporter()
+MAX_ROOTS_SHOWN = 3
+tagre = re.compile(r'\[([^]]*)\]\s*(.*)', re.UNICODE)
+
+
 ###############################################################################
 #### Functionality helpers ####################################################
 ###############################################################################
-def guess_savepath(resume_dat):
-    ''' Attempt to guess the save path for uTorrent data.
-        This works as following:
-            - First the common prefix of all save locations is calculated.
-              If this is longer than MIN_SAVEPATH_LENGTH, it is returned.
-            - If not, this means that multiple save locations are in use.
-              Then, it is attempted to use sampling to guess the most popular
-              one. If sampling succeeds, the savepath is returned.
-            - Else, an exception is raised.
+def savepath_root(p, l):
+    ''' Returns the save root of the torrent at path p with label l (without
+        its tag), i.e. the torrent directory without the label subdirectories.
+        Torrents in a directory not matching their label are assumed to be
+        in a single level label directory.
     '''
-    MIN_SAVEPATH_LENGTH = 3
-    SAVEPATH_SAMPLE_SIZE = 10
-    SAVEPATH_SAMPLE_RETRIES = 5
-
-    allpaths = [ resume_dat[t]['path'] for t in resume_dat
-        if t.endswith('.torrent') and os.path.exists(resume_dat[t]['path'])
-    ]
-    savepath = os.path.commonprefix(allpaths)
-    if (len(savepath) < MIN_SAVEPATH_LENGTH):
-        # Failed to calculate savepath from all used paths. Try sampling.
-        for i in xrange(SAVEPATH_SAMPLE_RETRIES):
-            savepath = os.path.commonprefix( random.sample(allpaths, min(SAVEPATH_SAMPLE_SIZE, len(allpaths))) )
-            if (len(savepath) >= MIN_SAVEPATH_LENGTH):
-                break
-        if (len(savepath) < MIN_SAVEPATH_LENGTH):
-            raise Exception("Guessing of the uTorrent save path failed. You may want to retry in a few secs, or manually set the savepath.")
-    return savepath
+    d = os.path.dirname(p)
+    if not l:
+        return d
+    ld = os.path.normpath(l)
+    if d.endswith(os.sep + ld):
+        return d[:-len(ld)-1] or os.sep
+    return os.path.dirname(d)
 
-def check_torrent(torrent, metadata, args, tagpath):
-    ''' Checks the torrent and its metadata to determine whether it
-        should be moved. For torrents that should be moved, a tuple
-        is returned. Otherwise a message is printed and None is returned.
+def guess_savepath(columns):
+    ''' Attempt to guess the save paths for uTorrent data.
+        This works as following:
+            - The save roots of all torrents are counted in one pass over
+              their paths, in a PathTrie for each label tag. The filesystem
+              is not accessed.
+            - The most frequent root of the untagged torrents (or of all
+              torrents, if all are tagged) is the default save path.
+            - For each tag, its most frequent root is suggested as its
+              save path, if different from the default.
+        Returns the default save path (or None, if it could not be guessed),
+        a dict of the suggested tag save paths and the tries with the roots
+        of the untagged (None) and tagged torrents.
     '''
-    use_emojis = True if 'emoji' in sys.modules else False
-    if use_emojis:
-        emj = lambda s: emoji.emojize(s, use_aliases=True).encode('utf-8')
+    MIN_SAVEPATH_LENGTH = 3
 
-    try: width = int(subprocess.check_output(['stty', 'size']).split()[1])
-    except: width = 80
+    tries = {None: PathTrie()}
+    alltrie = PathTrie()
+    for i in IS_TORRENT(columns):
+        p, l = columns.path[i], columns.label[i] or ''
+        if not p:
+            continue
+        t = None
+        match = tagre.match(l)
+        if match:
+            t, l = match.groups()
+        if t not in tries:
+            tries[t] = PathTrie()
+        root = savepath_root(p, l)
+        tries[t].insert(root)
+        alltrie.insert(root)
 
-    def _make_message(torrent, action, reason):
-        values = {
-            'torrent': fit_string(torrent, width-20-5-6, 'l'),
-            'action': fit_string(action, 5, 'l'),
-            'reason': fit_string(reason, 20, 'c'),
-        }
-        if use_emojis:
-            if action == 'skip':
-                values['action'] = fit_string(emj(':no_entry:'), 4, 'l')
-            elif action == 'ok':
-                values['action'] = fit_string(emj(':checkered_flag:'), 5, 'l')
-            elif action == 'move':
-                values['action'] = fit_string(emj(':arrow_right:'), 4, 'l')
-            elif action == 'xfs':
-                values['action'] = fit_string(emj(':warning:'), 4, 'l')
-            elif action == 'wtf':
-                values['action'] = fit_string(emj(':interrobang:'), 4, 'l')
-            else:
-                values['action'] = fit_string(emj(':question:'), 4, 'l')
-        return '{action} | {torrent} | {reason}'.format(**values)             
+    roots = (tries[None] if len(tries[None]) else alltrie).ends()
+    savepath = roots[0][0] if roots and len(roots[0][0]) >= MIN_SAVEPATH_LENGTH else None
+    suggested = {}
+    for t, trie in tries.items():
+        if t is not None and trie.ends()[0][0] != savepath:
+            suggested[t] = trie.ends()[0][0]
+    return savepath, suggested, tries
 
-    if not torrent.endswith('.torrent'):
-        print(_make_message(torrent, 'skip', 'not a torrent'))
-        return None
-    if 'label' not in metadata:
-        print(_make_message(torrent, 'skip', 'no label'))
-        return None
-    if len(metadata['labels']) > 1:
-        print(_make_message(torrent, 'wtf', 'multiple labels'))
-        return None
-    if metadata['completed_on'] == 0:
-        print(_make_message(torrent, 'skip', 'incomplete'))
-        return None
-    if not os.path.exists(metadata['path']):
-        print(_make_message(torrent, 'skip', 'invalid path'))
-        return None
+def tidy_rules(fscache):
+    ''' Returns the rules for selecting the torrents to check.'''
+    return FilterRules([
+        (IS_TORRENT, 'skip', 'not a torrent'),
+        (HAS_LABEL, 'skip', 'no label'),
+        (SINGLE_LABEL, 'wtf', 'multiple labels'),
+        (COMPLETE, 'skip', 'incomplete'),
+        (path_exists(fscache), 'skip', 'invalid path'),
+    ])
 
-    # Get path, label, tag.
-    p = metadata['path']
-    l = metadata['label']
+def check_torrent(torrent, p, l, args, tagpath, fscache):
+    ''' Checks the torrent path p and label l to determine whether it
+        should be moved. Only torrents selected by tidy_rules() should
+        be checked. For torrents that should be moved, a tuple is
+        returned. Otherwise a message is printed and None is returned.
+    '''
+    # Get tag.
     t = None
     if len(tagpath) > 1:
-        tagre = re.compile('\[([^]]*)\]\s*(.*)', re.UNICODE)
         match = tagre.match(l)
         if match:
             t, l = match.groups()
@@ -167,16 +120,15 @@ def check_torrent(torrent, metadata, args, tagpath):
     p_to = os.path.join(d_to, os.path.basename(p))
 
     # Check directories.
-    on_same_fs = lambda p1, p2: os.stat(p1).st_dev == os.stat(p2).st_dev
     if d_from == d_to:
-        print(_make_message(torrent, 'ok', 'no action required'))
+        reporter.report(torrent, 'ok', 'no action required')
         return None
-    elif not args.xfs and not on_same_fs(os.path.dirname(d_from), os.path.dirname(d_to)):
-        print(_make_message(torrent, 'xfs', 'xfs disabled'))
+    elif not args.xfs and not fscache.same_fs(os.path.dirname(d_from), os.path.dirname(d_to)):
+        reporter.report(torrent, 'xfs', 'xfs disabled')
         return None
 
     # everything ok - return an action tuple
-    print(_make_message(torrent, 'move', 'move to %s' % (t if t else 'default')))
+    reporter.report(torrent, 'move', 'move to %s' % (t if t else 'default'))
     return (p, p_to, d_to)    
 
 
@@ -212,17 +164,71 @@ def main():
         action="store_true", dest="xfs", default=False,
         help="allow moving files across filesystems"
     )
+    parser.add_argument("-j", "--jobs", type=int, default=None,
+        action="store", dest="jobs",
+        help="number of threads to use for scanning directories"
+    )
+    parser.add_argument("--copy-jobs", type=int, default=4,
+        action="store", dest="copy_jobs",
+        help="number of parallel copies when moving across filesystems (default: 4)"
+    )
+    parser.add_argument("--journal", default=None,
+        action="store", dest="journal",
+        help="journal of completed moves, used to resume interrupted runs (default: RESUMEDAT_OUT.journal)"
+    )
+    parser.add_argument("--snapshot", default=None,
+        action="store", dest="snapshot",
+        help="snapshot of the resume data, reused while the input file is unchanged (default: in ~/.cache/cliutils)"
+    )
+    parser.add_argument("--no-snapshot",
+        action="store_true", dest="no_snapshot", default=False,
+        help="always read the resume data from the input file"
+    )
     parser.add_argument('resumedat_in', help='input utorrent resume.dat file')
     parser.add_argument('resumedat_out', help='output utorrent resume.dat file')
     args = parser.parse_args()
 
     ################################################
     # Read resume data and calculate save paths.
+    # Torrent entries are only decoded when accessed.
     ################################################
-    with open(args.resumedat_in, 'rb') as dat_in:
-        resume_dat = bencode.bdecode(dat_in.read())
+    resume_dat = btcodec.load(args.resumedat_in)
+
+    # Apply the moves completed by an interrupted run and resume the rest.
+    journal = MoveJournal(args.journal if args.journal else '%s.journal' % (args.resumedat_out))
+    executor = MoveExecutor(journal, jobs=args.copy_jobs, dryrun=args.dryrun)
+    for torrent, moves in journal.done.items():
+        if torrent in resume_dat:
+            resume_dat[torrent]['path'] = moves[0][1]
+    pending = journal.pending
+    dests = {}
+    for torrent, moves in pending.items():
+        executor.add(torrent, moves)
+        dests[torrent] = moves[0][1]
 
-    savepath = args.savepath if args.savepath else guess_savepath(resume_dat)
+    # The fields used for planning come from a snapshot, when one is
+    # available for the input file.
+    snapshot_f = None if args.no_snapshot else (args.snapshot or snapshot_path(args.resumedat_in))
+    columns = load_columns(args.resumedat_in, resume_dat, snapshot_f)
+    for torrent, moves in journal.done.items():
+        i = columns.row(torrent)
+        if i is not None:
+            columns.path[i] = moves[0][1]
+
+    # Look up the torrent directories in one go, before any decisions.
+    fscache = FsCache(args.jobs)
+    fscache.prefetch([columns.path[i] for i in IS_TORRENT(columns)])
+
+    # Save paths that are not set by the user are guessed.
+    guessed_savepath, guessed_tagpath, roots = guess_savepath(columns)
+    if args.savepath:
+        savepath = args.savepath
+    elif guessed_savepath is not None:
+        savepath = guessed_savepath
+    else:
+        raise Exception("Guessing of the uTorrent save path failed. You may want to manually set the savepath.")
+    # Guessed tag paths are only suggested, torrents are moved to the
+    # user-set ones.
     tagpath = dict([tp.split(':', 1) for tp in args.tagpath]) if args.tagpath else {}
     tagpath['default'] = savepath
 
@@ -234,29 +240,41 @@ def main():
             'Move Across FS: %s' % (args.xfs),
             'Savepath[default]: %s (%s)' % (savepath, 'guessed' if not args.savepath else 'user-set'),
     ]
-    for tp in tagpath.iteritems():
-        cfg_banner.append('Savepath[%s]: %s' % (tp))
+    for t, tp in tagpath.items():
+        if t != 'default':
+            cfg_banner.append('Savepath[%s]: %s (user-set)' % (t, tp))
+    for t, trie in roots.items():
+        for root, count in trie.ends()[:MAX_ROOTS_SHOWN]:
+            cfg_banner.append('Root[%s]: %s (%d torrents)' % (t if t is not None else 'untagged', root, count))
     print_banner(cfg_banner)
+    for t in sorted(set(guessed_tagpath) - set(tagpath)):
+        print("Guessed tag path. Use -t '%s:%s' to set it explicitly." % (t, guessed_tagpath[t]))
     print('')
     
     ################################################
     # Check what has to be done.
     ################################################
     print_banner(['Analyzing actions'])
+    for torrent in pending:
+        reporter.report(torrent, 'move', 'resume move')
+    rows = [i for i, torrent in enumerate(columns.keys) if torrent not in pending]
     actions = {}
-    for torrent, metadata in resume_dat.iteritems():
-        action = check_torrent(torrent, metadata, args, tagpath)
+    for i in tidy_rules(fscache).select(columns, reporter, rows):
+        torrent = columns.keys[i]
+        action = check_torrent(torrent, columns.path[i], columns.label[i], args, tagpath, fscache)
         # everything ok, add an action.
         if action:
             actions[torrent] = action
+    reporter.flush()
     print('')
 
     ################################################
     # Execute actions.
     ################################################
     print_banner(['Hammer time!%s' % (' (dry run)' if args.dryrun else '')])
+    finished = False
     try:
-        if not actions:
+        if not actions and not pending:
             print('Nothing to do!')
         for torrent in actions:
             path_orig, path_dest, dir_dest = actions[torrent]
@@ -274,18 +292,28 @@ def main():
             except OSError:
                 pass
 
-            # Do the moving.
-            if not args.dryrun:
-                shutil.move(path_orig, dir_dest)
-            resume_dat[torrent]['path'] = path_dest
+            # Queue the moving. Paths are journaled absolute, so that an
+            # interrupted run can be resumed from any directory.
+            path_orig, path_dest = os.path.abspath(path_orig), os.path.abspath(path_dest)
+            executor.add(torrent, [(path_orig, path_dest)])
+            dests[torrent] = path_dest
             print("mv '%s' '%s'" % (path_orig, dir_dest))
             print_hr(fill='-')
+
+        # Do the moving.
+        for torrent in executor.run():
+            resume_dat[torrent]['path'] = dests[torrent]
+        finished = True
     finally:
         ################################################
         # Write updated resume data.
+        # Only changed entries are re-encoded and the new file is
+        # atomically renamed in place.
         ################################################
-        with open(args.resumedat_out,'wb+') as dat_out:
-            dat_out.write(bencode.bencode(resume_dat))
+        # The journal is kept for the moves not applied yet, if
+        # interrupted, and for the failed ones.
+        btcodec.save(resume_dat, args.resumedat_out)
+        journal.close(remove=finished and not journal.pending and not args.dryrun)
     print('Finished!')
 if __name__ == '__main__':
     main()